@@ -8,15 +8,90 @@ import glob
 from matplotlib.ticker import MultipleLocator
 from scipy.fft import fft,ifft
 import pickle
+import os
+import json
+import concurrent.futures
 from scipy.signal import lfilter,savgol_filter
 from scipy.optimize import fsolve,root_scalar,ridder,anderson,newton_krylov
+import timeline
+import echem_methods
 
 #define equilibrium constants
 k1=1.1*10**-6 
 k2=4.1*10**-10
 kw=10**-14
 henry_constant = 0.035
-def dic(co2aq,pH,solve_value = 0):
+
+#standard reaction enthalpies in J/mol, for the van 't Hoff temperature dependence of the constants
+CONSTANT_ENTHALPIES = {'k1':9150.,'k2':14900.,'kw':55800.,'henry_constant':-19950.}
+
+class EquilibriumConstants:
+    '''
+    Equilibrium constants of the carbonate system, to be passed as **constants** to the speciation functions instead of
+    using the module constants k1, k2, kw and henry_constant. Instances are never modified, so analyses of different
+    electrolytes can share a process or run in threads at the same time.
+
+    The constants may be arrays, e.g. one value per row of a dataset, and `at()` evaluates them at other temperatures
+    with the van 't Hoff equation, ln(K/K_ref) = -dH/R*(1/T-1/T_ref).
+
+    .. note::   Here is an example
+
+                .. code-block:: python
+
+                    constants = EquilibriumConstants(k1=1.3*10**-6)
+                    sample_constants = constants.at(total_df['Temperature'])
+                    DIC = speciation_from_TA_pH(TA_array,total_df['pH_right'],constants=sample_constants)['DIC']
+
+    :type k1: float or np.ndarray
+    :param k1: first dissociation constant of carbonic acid at **reference_temperature**
+
+    :type k2: float or np.ndarray
+    :param k2: second dissociation constant of carbonic acid at **reference_temperature**
+
+    :type kw: float or np.ndarray
+    :param kw: water dissociation constant at **reference_temperature**
+
+    :type henry_constant: float or np.ndarray
+    :param henry_constant: Henry's constant of CO2 in M/bar at **reference_temperature**
+
+    :type reference_temperature: float or np.ndarray
+    :param reference_temperature: temperature of the constants in degree Celsius, as recorded in the echem ['Temperature'] column
+
+    :type enthalpies: dict
+    :param enthalpies: standard reaction enthalpies in J/mol of 'k1', 'k2', 'kw' and 'henry_constant'
+    '''
+
+    def __init__(self,k1=k1,k2=k2,kw=kw,henry_constant=henry_constant,reference_temperature=25.0,enthalpies=CONSTANT_ENTHALPIES):
+        self.k1 = k1
+        self.k2 = k2
+        self.kw = kw
+        self.henry_constant = henry_constant
+        self.reference_temperature = reference_temperature
+        self.enthalpies = dict(enthalpies)
+
+    def __repr__(self):
+        return 'EquilibriumConstants(k1={},k2={},kw={},henry_constant={},reference_temperature={})'.format(
+            self.k1,self.k2,self.kw,self.henry_constant,self.reference_temperature)
+
+    def at(self,temperature):
+        '''
+        Returns new constants evaluated at **temperature** in degree Celsius. With an array of temperatures, e.g. a
+        ['Temperature'] column, every constant becomes an array with one value per sample.
+        '''
+        temperature = np.asarray(temperature,dtype=np.float64)
+        inverse_difference = 1/(temperature+273.15)-1/(np.asarray(self.reference_temperature,dtype=np.float64)+273.15)
+        scaled = {name:getattr(self,name)*np.exp(-enthalpy/8.314*inverse_difference) for name,enthalpy in self.enthalpies.items()}
+        return EquilibriumConstants(reference_temperature=temperature,enthalpies=self.enthalpies,**scaled)
+
+def _constant_values(constants):
+    '''
+    (k1, k2, kw, henry_constant) of **constants**, or the module constants if **constants** is None.
+    '''
+    if constants is None:
+        return k1,k2,kw,henry_constant
+    return constants.k1,constants.k2,constants.kw,constants.henry_constant
+
+def dic(co2aq,pH,solve_value = 0,constants=None):
     """
     Calculate DIC given aqueous co2 concentration (**co2aq**) and pH. **solve_value** is used when one tries to solve for **co2aq**
     or **pH** given DIC value (enter targeting DIC value for **solve_value**).
@@ -30,12 +105,16 @@ def dic(co2aq,pH,solve_value = 0):
     :type solve_value: float
     :param solve_value: Target DIC value when using solvers from scipy.optimize
 
+    :type constants: EquilibriumConstants
+    :param constants: equilibrium constants. If None, the module constants are used.
+
     :rtype: *float*
     :return: DIC value
     """
+    k1,k2,_,_ = _constant_values(constants)
     return co2aq*(1 + k1/10**-pH + k1*k2/(10**-pH)**2)-solve_value
 
-def hco3(co2aq,pH,solve_value = 0):
+def hco3(co2aq,pH,solve_value = 0,constants=None):
     """
     Calculate bicarbonate concentration given aqueous co2 concentration (**co2aq**) and pH. **solve_value** is used when one tries to solve for **co2aq**
     or **pH** given bicarbonate concentration value (enter targeting bicarbonate concentration for **solve_value**).
@@ -49,12 +128,16 @@ def hco3(co2aq,pH,solve_value = 0):
     :type solve_value: float
     :param solve_value: Target bicarbonate concentration value when using solvers from scipy.optimize
 
+    :type constants: EquilibriumConstants
+    :param constants: equilibrium constants. If None, the module constants are used.
+
     :rtype: *float*
     :return: bicarbonate concentration
     """
-    return dic(co2aq,pH)/(1+10**-pH/k1+k2/10**-pH)-solve_value
+    k1,k2,_,_ = _constant_values(constants)
+    return dic(co2aq,pH,constants=constants)/(1+10**-pH/k1+k2/10**-pH)-solve_value
 
-def co32(co2aq,pH,solve_value = 0):
+def co32(co2aq,pH,solve_value = 0,constants=None):
     """
     Calculate carbonate concentration given aqueous co2 concentration (**co2aq**) and pH. **solve_value** is used when one tries to solve for **co2aq**
     or **pH** given carbonate concentration value (enter targeting carbonate concentration for **solve_value**).
@@ -68,12 +151,16 @@ def co32(co2aq,pH,solve_value = 0):
     :type solve_value: float
     :param solve_value: Target carbonate concentration value when using solvers from scipy.optimize
 
+    :type constants: EquilibriumConstants
+    :param constants: equilibrium constants. If None, the module constants are used.
+
     :rtype: *float*
     :return: carbonate concentration
     """
-    return dic(co2aq,pH)/(1+10**-pH/k2+(10**-pH)**2/(k1*k2))-solve_value
+    k1,k2,_,_ = _constant_values(constants)
+    return dic(co2aq,pH,constants=constants)/(1+10**-pH/k2+(10**-pH)**2/(k1*k2))-solve_value
 
-def TA(co2aq,pH,solve_value = 0):
+def TA(co2aq,pH,solve_value = 0,constants=None):
     """
     Calculate total alkalinity(TA) given aqueous co2 concentration (**co2aq**) and pH. **solve_value** is used when one tries to solve for **co2aq**
     or **pH** given TA value (enter targeting TA value for **solve_value**).
@@ -87,12 +174,262 @@ def TA(co2aq,pH,solve_value = 0):
     :type solve_value: float
     :param solve_value: Target TA value when using solvers from scipy.optimize
 
+    :type constants: EquilibriumConstants
+    :param constants: equilibrium constants. If None, the module constants are used.
+
     :rtype: *float*
     :return: TA value
     """
-    return kw/(10**-pH)+hco3(co2aq,pH)+2*co32(co2aq,pH)-10**-pH-solve_value
+    _,_,kw,_ = _constant_values(constants)
+    return kw/(10**-pH)+hco3(co2aq,pH,constants=constants)+2*co32(co2aq,pH,constants=constants)-10**-pH-solve_value
+
+def co2aq_from_TA_pH(TA_val,pH,constants=None):
+    """
+    Calculate aqueous co2 concentration given total alkalinity (**TA_val**) and **pH**. TA is linear in co2aq, so
+    this is the exact inverse of `TA()` and works element-wise on arrays.
+
+    :type TA_val: float or np.ndarray
+    :param TA_val: TA value
+
+    :type pH: float or np.ndarray
+    :param pH: pH value
+
+    :type constants: EquilibriumConstants
+    :param constants: equilibrium constants. If None, the module constants are used.
+
+    :rtype: *float or np.ndarray*
+    :return: Aqueous co2 concentration
+    """
+    k1,k2,kw,_ = _constant_values(constants)
+    h = 10**-np.asarray(pH,dtype=np.float64)
+    return (TA_val-kw/h+h)/(k1/h+2*k1*k2/h**2)
+
+def speciation_from_TA_pH(TA_val,pH,constants=None):
+    """
+    Calculate the carbonate speciation given total alkalinity (**TA_val**) and **pH** in closed form. Works element-wise on
+    arrays, e.g. DIC \ :sub:`TA`\  of every sample of a dataset in one call.
+
+    .. note::   Here is an example
+
+                .. code-block:: python
+
+                    DIC_TA = speciation_from_TA_pH(total_df['TA'],total_df['pH_right'])['DIC']
+
+    :type TA_val: float or np.ndarray
+    :param TA_val: TA value
+
+    :type pH: float or np.ndarray
+    :param pH: pH value
+
+    :type constants: EquilibriumConstants
+    :param constants: equilibrium constants. If None, the module constants are used.
+
+    :rtype: *dict*
+    :return: a dictionary of concentrations in Molar:
+
+        dict['co2aq'] -> (*float or np.ndarray*): aqueous co2 concentration\n
+        dict['DIC'] -> (*float or np.ndarray*): DIC\n
+        dict['HCO3'] -> (*float or np.ndarray*): bicarbonate concentration\n
+        dict['CO3'] -> (*float or np.ndarray*): carbonate concentration\n
+    """
+    k1,k2,kw,_ = _constant_values(constants)
+    h = 10**-np.asarray(pH,dtype=np.float64)
+    co2aq = (TA_val-kw/h+h)/(k1/h+2*k1*k2/h**2)
+    #same expressions as dic(), hco3() and co32(), with [H+] computed once
+    hco3_val = co2aq*k1/h
+    co32_val = hco3_val*k2/h
+    return {'co2aq':co2aq,'DIC':co2aq+hco3_val+co32_val,'HCO3':hco3_val,'CO3':co32_val}
+
+
+def _pH_lookup_midpoints(axis,log):
+    if log:
+        return np.sqrt(axis[1:]*axis[:-1])
+    return (axis[1:]+axis[:-1])/2
+
+def _interpolate_table(table,TA_val,pco2):
+    """
+    Bilinear interpolation of **table** at (**TA_val**, **pco2**), in log10(pCO2) if the table was built that way.
+    Returns NaN outside the table.
+    """
+    TA_axis,pco2_axis = table['TA'],table['pco2']
+    x,y = np.asarray(TA_val,dtype=np.float64),np.asarray(pco2,dtype=np.float64)
+    inside = (x>=TA_axis[0])&(x<=TA_axis[-1])&(y>=pco2_axis[0])&(y<=pco2_axis[-1])
+    if table['log_pco2']:
+        with np.errstate(divide='ignore',invalid='ignore'):
+            y,pco2_axis = np.log10(y),np.log10(pco2_axis)
+    i = np.clip(np.searchsorted(TA_axis,x,side='right')-1,0,len(TA_axis)-2)
+    j = np.clip(np.searchsorted(pco2_axis,y,side='right')-1,0,len(pco2_axis)-2)
+    u = (x-TA_axis[i])/(TA_axis[i+1]-TA_axis[i])
+    v = (y-pco2_axis[j])/(pco2_axis[j+1]-pco2_axis[j])
+    pH = table['pH']
+    value = (1-u)*(1-v)*pH[i,j]+u*(1-v)*pH[i+1,j]+(1-u)*v*pH[i,j+1]+u*v*pH[i+1,j+1]
+    return np.where(inside,value,np.nan)
+
+def create_pH_lookup_table(min_TA=0,max_TA=1.0,min_pco2=1e-4,max_pco2=1.0,tolerance=1e-4,TA_points=33,pco2_points=33,
+                           max_points=8193,log_pco2=True,constants=None):
+    """
+    Creates a lookup table of equilibrium pH and DIC over a TA x pCO2 grid, for fast repeated evaluation with
+    `lookup_pH_DIC()`. Starting from **TA_points** x **pco2_points**, the intervals of each axis are halved where
+    needed until the bilinear interpolation error at the midpoints of the grid intervals and cells, checked against the
+    exact solution of `solve_pH()`, is below **tolerance** pH units. The axes end up denser where pH changes fast,
+    e.g. near TA=0. The error is only checked at these midpoints, so **tolerance** is a target rather than a
+    guaranteed bound: the error elsewhere in a cell is usually smaller but can slightly exceed it. Use a smaller
+    **tolerance** to leave a margin.
+
+    .. note::   Here is an example
+
+                .. code-block:: python
+
+                    table = create_pH_lookup_table(0,0.5,0.01,1.0)
+                    save_pH_lookup_table(table,'pH_table')
+                    #...in another process
+                    table = load_pH_lookup_table('pH_table')
+                    pH,DIC = lookup_pH_DIC(table,TA_array,pco2_array)
+
+    :type min_TA: float
+    :param min_TA: Minimum total alkalinity in Molar
+
+    :type max_TA: float
+    :param max_TA: Maximum total alkalinity in Molar
+
+    :type min_pco2: float
+    :param min_pco2: Minimum CO2 partial pressure in bar
+
+    :type max_pco2: float
+    :param max_pco2: Maximum CO2 partial pressure in bar
+
+    :type tolerance: float
+    :param tolerance: Target interpolation error in pH units, checked at the midpoints of the grid intervals and cells
+
+    :type TA_points: int
+    :param TA_points: Initial number of points of the TA axis
+
+    :type pco2_points: int
+    :param pco2_points: Initial number of points of the pCO2 axis
+
+    :type max_points: int
+    :param max_points: Maximum number of points of each axis. A ValueError is raised if **tolerance** is not reached within it.
+
+    :type log_pco2: boolean
+    :param log_pco2: If True, the pCO2 axis is spaced (and interpolated) in log10(pCO2), which needs far fewer points since pH is close to linear in log10(pCO2). **min_pco2** must be positive.
+
+    :type constants: EquilibriumConstants
+    :param constants: equilibrium constants, with one value each (e.g. `EquilibriumConstants().at(40)`). If None, the module constants are used. They are stored in the table, and `lookup_pH_DIC()` uses them.
+
+    :rtype: *dict*
+    :return: a dictionary with the table:
+
+        dict['TA'] -> (*np.ndarray*): TA axis in Molar\n
+        dict['pco2'] -> (*np.ndarray*): pCO2 axis in bar\n
+        dict['pH'] -> (*np.ndarray*): equilibrium pH, of shape (len(TA), len(pco2))\n
+        dict['DIC'] -> (*np.ndarray*): equilibrium DIC in Molar, of shape (len(TA), len(pco2))\n
+        dict['log_pco2'] -> (*boolean*): whether pCO2 is interpolated in log10\n
+        dict['max_error'] -> (*float*): largest interpolation error in pH units found at the midpoints, an estimate of the error of the table\n
+        dict['constants'] -> (*dict*): 'k1', 'k2', 'kw' and 'henry_constant' of the table\n
+    """
+    if log_pco2 and min_pco2 <= 0:
+        raise ValueError('min_pco2 must be positive when log_pco2 is True')
+    TA_axis = np.linspace(min_TA,max_TA,TA_points)
+    pco2_axis = np.logspace(np.log10(min_pco2),np.log10(max_pco2),pco2_points) if log_pco2 else np.linspace(min_pco2,max_pco2,pco2_points)
+    table_constants = _table_constants(constants)
+    constants = EquilibriumConstants(**table_constants)
+    henry = table_constants['henry_constant']
+    pH = solve_pH(pco2_axis*henry,TA_axis[:,None],constants=constants)[0]
+    while True:
+        table = {'TA':TA_axis,'pco2':pco2_axis,'pH':pH,'log_pco2':log_pco2,'constants':table_constants}
+
+        #interpolation error at the midpoints of the TA intervals, of the pCO2 intervals and of the cells
+        TA_mid,pco2_mid = _pH_lookup_midpoints(TA_axis,False),_pH_lookup_midpoints(pco2_axis,log_pco2)
+        error = lambda x,y: np.abs(_interpolate_table(table,x,y)-solve_pH(y*henry,x,constants=constants)[0])
+        TA_error = error(TA_mid[:,None],pco2_axis).max(axis=1)
+        pco2_error = error(TA_axis[:,None],pco2_mid).max(axis=0)
+        center_error = error(TA_mid[:,None],pco2_mid)
+        max_error = max(TA_error.max(),pco2_error.max(),center_error.max())
+        if max_error <= tolerance:
+            break
+
+        #only the intervals that miss the tolerance are split. A cell that only misses it at its center is split both ways
+        split_TA,split_pco2 = TA_error>tolerance,pco2_error>tolerance
+        center_only = (center_error>tolerance)&~split_TA[:,None]&~split_pco2
+        split_TA |= center_only.any(axis=1)
+        split_pco2 |= center_only.any(axis=0)
+        TA_axis = np.sort(np.concatenate([TA_axis,TA_mid[split_TA]]))
+        pco2_axis = np.sort(np.concatenate([pco2_axis,pco2_mid[split_pco2]]))
+        if max(len(TA_axis),len(pco2_axis)) > max_points:
+            raise ValueError('Tolerance {} not reached with {} points per axis (error {})'.format(tolerance,max_points,max_error))
+        pH = solve_pH(pco2_axis*henry,TA_axis[:,None],constants=constants)[0]
+
+    table['DIC'] = dic(pco2_axis*henry,pH,constants=constants)
+    table['max_error'] = float(max_error)
+    return table
+
+def _table_constants(constants):
+    """
+    **constants** (the module constants if None) as the dictionary of floats stored in a pH lookup table.
+    """
+    return dict(zip(['k1','k2','kw','henry_constant'],[float(value) for value in _constant_values(constants)]))
+
+def save_pH_lookup_table(table,path):
+    """
+    Saves a table created by `create_pH_lookup_table()` to the folder **path**, one .npy file per array, so that
+    `load_pH_lookup_table()` can memory-map it. The equilibrium constants of the table are saved in table.json.
+    """
+    os.makedirs(path,exist_ok=True)
+    for name in ['TA','pco2','pH','DIC']:
+        np.save(os.path.join(path,name+'.npy'),table[name])
+    with open(os.path.join(path,'table.json'),'w') as f:
+        json.dump({'log_pco2':table['log_pco2'],'max_error':table['max_error'],'constants':table['constants']},f)
+
+def load_pH_lookup_table(path):
+    """
+    Loads a table saved by `save_pH_lookup_table()`. The arrays are memory-mapped read-only, so loading is instant and
+    processes that load the same folder share one copy through the page cache. Pass the folder, not the table, to
+    worker processes.
+    """
+    with open(os.path.join(path,'table.json')) as f:
+        table = json.load(f)
+    #tables saved without constants were built with the module constants
+    table.setdefault('constants',_table_constants(None))
+    for name in ['TA','pco2','pH','DIC']:
+        table[name] = np.load(os.path.join(path,name+'.npy'),mmap_mode='r')
+    return table
+
+def lookup_pH_DIC(table,TA_val,pco2,constants=None):
+    """
+    Equilibrium pH and DIC for arrays of **TA_val** and **pco2**, interpolated from a table created by
+    `create_pH_lookup_table()` or `load_pH_lookup_table()`. Points outside the table are solved exactly with `solve_pH()`,
+    with the equilibrium constants of the table.
+
+    :type table: dict
+    :param table: lookup table
 
-def TA_pH_wrapper(co2aq,solve_value = 0):
+    :type TA_val: float or np.ndarray
+    :param TA_val: TA value in Molar
+
+    :type pco2: float or np.ndarray
+    :param pco2: CO2 partial pressure in bar. Broadcast against **TA_val**
+
+    :type constants: EquilibriumConstants
+    :param constants: equilibrium constants expected by the caller. If given, a ValueError is raised when they are not the ones the table was built with.
+
+    :rtype: *tuple*
+    :return: (pH, DIC). DIC is computed from the interpolated pH, so both are consistent.
+    """
+    table_constants = table['constants']
+    if constants is not None:
+        expected = _table_constants(constants)
+        if not np.allclose([expected[name] for name in table_constants],list(table_constants.values()),rtol=1e-12,atol=0):
+            raise ValueError('The table was built with {}, not with {}'.format(table_constants,expected))
+    henry = table_constants['henry_constant']
+    constants = EquilibriumConstants(**table_constants)
+    TA_val,pco2 = np.broadcast_arrays(np.asarray(TA_val,dtype=np.float64),np.asarray(pco2,dtype=np.float64))
+    pH = np.asarray(_interpolate_table(table,TA_val,pco2),dtype=np.float64).reshape(TA_val.shape)
+    outside = np.isnan(pH)
+    if outside.any():
+        pH[outside] = solve_pH(pco2[outside]*henry,TA_val[outside],constants=constants)[0]
+    return pH,dic(pco2*henry,pH,constants=constants)
+
+def TA_pH_wrapper(co2aq,solve_value = 0,constants=None):
     """A function wrapper used when using newton_krylov solver solving for pH given **co2aq** and **TA**, which doesn't take additional arguments
     
     :type co2aq: float
@@ -101,6 +438,9 @@ def TA_pH_wrapper(co2aq,solve_value = 0):
     :type solve_value: float
     :param solve_value: Target TA value when using solvers from scipy.optimize
 
+    :type constants: EquilibriumConstants
+    :param constants: equilibrium constants. If None, the module constants are used.
+
     :rtype: *func*
     :return: a function used for newton_krylov solver to solve for pH, given **co2aq** and **solve_value** (TA concentration) value
     
@@ -121,10 +461,107 @@ def TA_pH_wrapper(co2aq,solve_value = 0):
     """
 
     def func(pH):
-        return kw/(10**-pH)+hco3(co2aq,pH)+2*co32(co2aq,pH)-10**-pH-solve_value
+        return TA(co2aq,pH,constants=constants)-solve_value
     return func
 
-def calc_DIC(total_df,echem_time_df,gas_change_time_df,outgas_shift=20,volume=0.01,flag=0,solver="newton_krylov"):
+def solve_pH(co2aq,TA_val,pH_guess=7.0,pH_min=-2.0,pH_max=16.0,xtol=1e-10,max_iter=100,constants=None):
+    """
+    Solves for pH given **co2aq** and **TA_val** for whole arrays at once. With A = kw/[H+]+[HCO3-]+2[CO3 2-], the TA
+    balance is rewritten as ln(A) = ln(TA+[H+]) (or ln(A-TA) = ln([H+]) for negative TA), whose sides are nearly
+    linear in pH, and solved by Newton steps in pH. Both sides are monotonic, so each root is kept in a bracket that
+    starts at [**pH_min**, **pH_max**] and steps that leave the bracket are replaced by bisection. Only elements that
+    have not converged are updated in each iteration.
+
+    .. note::   Here is an example
+
+                .. code-block:: python
+
+                    pH_theory,converged = solve_pH(0.0035,0.2)
+                    pH_theory
+
+                    >> array(7.69814977)
+
+    :type co2aq: float or np.ndarray
+    :param co2aq: Aqueous co2 concentration
+
+    :type TA_val: float or np.ndarray
+    :param TA_val: Target TA value. Broadcast against **co2aq**
+
+    :type pH_guess: float or np.ndarray
+    :param pH_guess: Initial guess of pH, e.g. the measured pH
+
+    :type pH_min: float
+    :param pH_min: Lower end of the pH bracket
+
+    :type pH_max: float
+    :param pH_max: Upper end of the pH bracket
+
+    :type xtol: float
+    :param xtol: Convergence tolerance on the pH step
+
+    :type max_iter: int
+    :param max_iter: Maximum number of iterations
+
+    :type constants: EquilibriumConstants
+    :param constants: equilibrium constants, which may be arrays broadcast against **co2aq**. If None, the module constants are used.
+
+    :rtype: *tuple*
+    :return: (pH, converged), arrays with the broadcast shape of the inputs. pH is NaN where the root is not inside the bracket or the inputs are NaN, and converged is False where pH did not converge.
+    """
+    k1,k2,kw,_ = [np.asarray(value,dtype=np.float64) for value in _constant_values(constants)]
+    co2aq,TA_val,pH_guess,k1,k2,kw = np.broadcast_arrays(np.asarray(co2aq,dtype=np.float64),np.asarray(TA_val,dtype=np.float64),
+                                                         np.asarray(pH_guess,dtype=np.float64),k1,k2,kw)
+    shape = co2aq.shape
+    co2aq,TA_val = co2aq.ravel(),TA_val.ravel()
+    #one value per element, indexed like co2aq
+    k1,k2,kw = k1.ravel(),k2.ravel(),kw.ravel()
+
+    def residual(c,target,pH):
+        h = 10**-pH
+        return kw/h+c*k1/h+2*c*k1*k2/h**2-h-target
+
+    def log_residual(c,target,pH,k1,k2,kw):
+        #increasing in pH and defined everywhere: A > 0 always and A-TA > 0 for negative TA
+        h = 10**-pH
+        alkalinity = (kw+c*k1)/h+2*c*k1*k2/h**2
+        d_alkalinity = (kw+c*k1)/h+4*c*k1*k2/h**2
+        positive = target>=0
+        with np.errstate(divide='ignore',invalid='ignore'):
+            f = np.where(positive,np.log(alkalinity)-np.log(target+h),np.log(alkalinity-target)+pH*np.log(10))
+            df = np.log(10)*np.where(positive,d_alkalinity/alkalinity+h/(target+h),d_alkalinity/(alkalinity-target)+1)
+        return f,df
+
+    lo = np.full(co2aq.size,pH_min)
+    hi = np.full(co2aq.size,pH_max)
+    pH = np.clip(pH_guess.ravel(),pH_min,pH_max)
+    converged = np.zeros(co2aq.size,dtype=bool)
+    #roots outside the bracket (or NaN inputs) are never solved
+    active = np.flatnonzero((residual(co2aq,TA_val,lo)<=0)&(residual(co2aq,TA_val,hi)>=0))
+    solvable = np.zeros(co2aq.size,dtype=bool)
+    solvable[active] = True
+
+    for _ in range(max_iter):
+        if active.size == 0:
+            break
+        c,target,x = co2aq[active],TA_val[active],pH[active]
+        f,df = log_residual(c,target,x,k1[active],k2[active],kw[active])
+        #shrink the bracket around the root
+        lo[active] = np.where(f<0,x,lo[active])
+        hi[active] = np.where(f>0,x,hi[active])
+        with np.errstate(invalid='ignore'):
+            x_new = x-f/df
+        newton_done = (np.abs(x_new-x)<xtol)|(f==0)
+        outside = ~newton_done&~((x_new>lo[active])&(x_new<hi[active]))
+        x_new[outside] = 0.5*(lo[active][outside]+hi[active][outside])
+        pH[active] = x_new
+        done = newton_done|(hi[active]-lo[active]<xtol)
+        converged[active[done]] = True
+        active = active[~done]
+
+    pH[~solvable] = np.nan
+    return pH.reshape(shape),converged.reshape(shape)
+
+def calc_DIC(total_df,echem_time_df,gas_change_time_df,outgas_shift=20,volume=0.01,flag=0,solver="newton_krylov",timeline_index=None):
     
     """
     Calculates DIC \ :sub:`TA`\, DIC \ :sub:`eq`\, pH  \ :sub:`theory,eq`\ and DIC \ :sub:`theory,eq`\, given the echem_gas_dataframe(**total_df**)
@@ -155,7 +592,10 @@ def calc_DIC(total_df,echem_time_df,gas_change_time_df,outgas_shift=20,volume=0.
     :param flag: flag for debug. 0 for not showing any message. 
 
     :type solver: string
-    :param solver: name of scipy solver used for solving theoretical pH, given TA and co2aq (assuming equilibrium). The default solver is "newton_krylov". If encounter any issue, try "fsolve"
+    :param solver: name of the solver used for solving theoretical pH, given TA and co2aq (assuming equilibrium). The default solver is "newton_krylov". If encounter any issue, try "fsolve". "vectorized" solves all states at once with `solve_pH()`, which is much faster.
+
+    :type timeline_index: timeline.TimelineIndex
+    :param timeline_index: index over total_df['Datetime'] used to locate the states. If None, one is built. Pass an index with a tolerance to match state times that are not exactly in **total_df**.
 
     :rtype: *pd.DataFrame*
     :return: A dataset that contains DIC \ :sub:`TA`\, DIC \ :sub:`eq`\, pH  \ :sub:`theory,eq`\ and DIC \ :sub:`theory,eq`\ for state 3'i, 1, 1', 3 and 3'f for each cycle.
@@ -168,7 +608,7 @@ def calc_DIC(total_df,echem_time_df,gas_change_time_df,outgas_shift=20,volume=0.
         dataset['DIC_TA'] -> (*float*): DIC \ :sub:`TA`\ value in Molar. DIC value calculated based on TA and measured pH, assuming no crossover of non-conservative ions.\n
         dataset['DIC_eq'] -> (*float*): DIC \ :sub:`eq`\ value in Molar. DIC value calculated based on measured pH and assuming gas-solution equilibrium, i.e. co2aq = pCO2*0.035 (Henry's constant)\n
         dataset['DIC_theory'] -> (*float*): DIC \ :sub:`theory,eq`\ value in Molar. DIC value calculated based on TA and theoretical pH.\n
-        dataset['index'] -> (*int*): The index in **total_df** where each of the above value is calculated.\n
+        dataset['index'] -> (*int*): The row position in **total_df** where each of the above value is calculated.\n
         dataset['Delta_DIC_TA'] -> (*float*) : The amount of DIC \ :sub:`TA`\ change in terms of Molar.\n
         dataset['Delta_DIC_eq'] -> (*float*) : The amount of DIC \ :sub:`eq`\ change in terms of Molar.\n
         dataset['Delta_DIC_theory'] -> (*float*) : The amount of DIC \ :sub:`theory,eq`\ change in terms of Molar.\n
@@ -189,14 +629,21 @@ def calc_DIC(total_df,echem_time_df,gas_change_time_df,outgas_shift=20,volume=0.
     Delta_DIC_TA_array = []
     Delta_DIC_eq_array = []
     Delta_DIC_theory_array = []
+    co2aq_array = []
     
     
     cycle_num = len(echem_time_df)
 
+    if timeline_index is None:
+        timeline_index = timeline.TimelineIndex(total_df)
+    states = timeline_index.map_states(echem_time_df,gas_change_time_df,outgas_shift)
+    #charge passed before each row, integrated once
+    charge = _echem_charge(total_df)
+
     for i in range(cycle_num):
         for j in range(5):
             if j == 0:
-                initial_index = (total_df[total_df['Datetime']==echem_time_df.iloc[i]['Charge_Start_Time']].index+1).values[0]
+                initial_index = states[(i+1,'3\'i')]
                 initial_entry = total_df.iloc[initial_index]
                 if i==0:
                     
@@ -222,25 +669,16 @@ def calc_DIC(total_df,echem_time_df,gas_change_time_df,outgas_shift=20,volume=0.
                 Delta_DIC_TA_array.append(0)
                 Delta_DIC_eq_array.append(0)
                 Delta_DIC_theory_array.append(0)
+                co2aq_array.append(initial_co2aq)
                 if(flag):
                     print("Cycle number:",i+1," state:",'3\'i', "co2aq: %0.3f"%initial_co2aq, "TA_val: %0.2f"%initial_TA,"pH measured: %0.2f"%initial_pH)
             else:
-                if j == 1:
-                    state = '1'
-                    index = total_df[total_df['Datetime']==gas_change_time_df.iloc[i]['low_to_high']].index.values[0]
-                elif j == 2:
-                    state = '1\''
-                    index = total_df[total_df['Datetime']==echem_time_df.iloc[i]['Discharge_Start_Time']].index.values[0]
-                elif j == 3:
-                    state = '3'
-                    index = total_df[total_df['Datetime']==gas_change_time_df.iloc[i]['high_to_low']].index.values[0]
-                elif j == 4:
-                    state = '3\'f'
-                    index = (total_df[total_df['Datetime']==echem_time_df.iloc[i]['Outgas_End_Time']].index-outgas_shift).values[0]
+                state = ['1','1\'','3','3\'f'][j-1]
+                index = states[(i+1,state)]
 
                 entry = total_df.iloc[index]
                 pH_measured = entry['pH_right']
-                TA_val = TA_array[-1]+np.sum(total_df.iloc[index_array[-1]:index].Current)/96485/volume
+                TA_val = TA_array[-1]+delta_TA(charge,index_array[-1],index,volume)
                 pCO2 = (entry['CO2 input right(abs val)']/(entry['CO2 input right(abs val)']+entry['N2 input right(abs val)']))
                 co2aq = pCO2*henry_constant
                 
@@ -252,9 +690,12 @@ def calc_DIC(total_df,echem_time_df,gas_change_time_df,outgas_shift=20,volume=0.
                     pH_theory = newton_krylov(pH_func,pH_measured)#use measured pH as the initial guess
                 elif solver == "fsolve":
                     pH_theory = fsolve(pH_func,pH_measured)[0]
+                elif solver == "vectorized":
+                    #solved for all states at once after the loop
+                    pH_theory = np.nan
                 #print(co2aq,TA_val,pH_func(pH_measured),pH_theory,pH_measured)
 
-                co2aq_TA = fsolve(TA,co2aq,args=(pH_measured,TA_val))[0]# non-equilibrium co2aq, calculated from TA,use equilibrium co2aq as initial guess
+                co2aq_TA = co2aq_from_TA_pH(TA_val,pH_measured)# non-equilibrium co2aq, calculated from TA
                 
                 DIC_TA = dic(co2aq_TA,pH_measured)
                 DIC_eq = dic(co2aq,pH_measured)
@@ -274,6 +715,14 @@ def calc_DIC(total_df,echem_time_df,gas_change_time_df,outgas_shift=20,volume=0.
                 Delta_DIC_TA_array.append(DIC_TA-DIC_TA_array[-2])
                 Delta_DIC_eq_array.append(DIC_eq-DIC_eq_array[-2])
                 Delta_DIC_theory_array.append(DIC_theory-DIC_theory_array[-2])
+                co2aq_array.append(co2aq)
+
+    if solver == "vectorized" and len(states_array):
+        initial_state = np.array(states_array)=='3\'i'
+        pH_theory_array = np.where(initial_state,pH_measured_array,
+                                   solve_pH(np.array(co2aq_array),np.array(TA_array),pH_guess=np.array(pH_measured_array))[0])
+        DIC_theory_array = np.where(initial_state,DIC_theory_array,dic(np.array(co2aq_array),pH_theory_array))
+        Delta_DIC_theory_array = np.where(initial_state,0,np.diff(DIC_theory_array,prepend=np.nan))
     
     return pd.DataFrame({"Cycle":cycle_array,"State":states_array,"pH_measured" :pH_measured_array,
                          "pH_theory":pH_theory_array,"TA":TA_array,'DIC_TA':DIC_TA_array,
@@ -283,10 +732,334 @@ def calc_DIC(total_df,echem_time_df,gas_change_time_df,outgas_shift=20,volume=0.
                         })
 
 
+def _echem_charge(total_df,initial_time=None):
+    """
+    Charge passed before each row of **total_df**, from `echem_methods.cumulative_charge()` integrated against the echem
+    time ['Time'], which has the real sample spacing; ['Datetime'] repeats a second when two echem samples fall in it.
+    If **initial_time** is None, the first sample is integrated from the start of its Gamry file.
+    """
+    if initial_time is None:
+        samples = total_df['Time'].notna().to_numpy()
+        if samples.any():
+            first = np.argmax(samples)
+            initial_time = total_df['Time'].iloc[first]-pd.to_timedelta(total_df['Delta_T_s'].iloc[first],unit='s')
+    return echem_methods.cumulative_charge(total_df['Current'],total_df['Time'],initial_time=initial_time)
+
+def delta_TA(charge,start,end,volume=0.01):
+    """
+    Calculate the TA change between row positions **start** and **end** from the prefix charge of
+    `echem_methods.cumulative_charge()`, as an O(1) difference. **start**, **end** and **volume** may be arrays, e.g. to
+    re-evaluate TA for many electrolyte volumes at once.
+
+    :type charge: np.ndarray
+    :param charge: charge in Coulomb passed before each row, created by `echem_methods.cumulative_charge()`
+
+    :type start: int or np.ndarray
+    :param start: row position(s) of the initial state
+
+    :type end: int or np.ndarray
+    :param end: row position(s) of the final state
+
+    :type volume: float or np.ndarray
+    :param volume: Volume in litre. The volume of the electrolyte
+
+    :rtype: *float or np.ndarray*
+    :return: TA change in Molar, with shape volume.shape+start.shape
+    """
+    charge = np.asarray(charge)
+    return np.multiply.outer(1/(96485*np.asarray(volume,dtype=np.float64)),charge[end]-charge[start])
+
+def _cycle_TA_anchors(total_df,echem_time_df,pH_attribute='pH_right',timeline_index=None,constants=None,temperature_attribute=None):
+    """
+    Returns the row positions in **total_df** where each cycle's TA is anchored (the row after echem_time_df['Charge_Start_Time']),
+    the anchored TA and the initial pH it is computed from, as in state 3'i of `calc_DIC()`, with **constants** at the
+    temperature of the row if **temperature_attribute** is given.
+    """
+    if timeline_index is None:
+        timeline_index = timeline.TimelineIndex(total_df)
+    positions = np.array([timeline_index.locate(time)+1 for time in echem_time_df['Charge_Start_Time']],dtype=np.int64)
+    TA_values = np.empty(len(positions))
+    pH_values = np.empty(len(positions))
+    for i,position in enumerate(positions):
+        entry = total_df.iloc[position]
+        if i == 0:
+            initial_pH = entry[pH_attribute]
+        else:
+            #previous 20 rows for calculating a more reliable initial pH
+            initial_pH = np.average(total_df.iloc[position-20:position][pH_attribute])
+        initial_pCO2 = entry['CO2 input right(abs val)']/(entry['CO2 input right(abs val)']+entry['N2 input right(abs val)'])
+        entry_constants = _series_constants(constants,entry[temperature_attribute]) if temperature_attribute else constants
+        TA_values[i] = TA(initial_pCO2*_constant_values(entry_constants)[3],initial_pH,constants=entry_constants)
+        pH_values[i] = initial_pH
+    return positions,TA_values,pH_values
+
+def _series_constants(constants,temperature):
+    """
+    **constants** (the module constants if None) evaluated at **temperature**. Missing temperatures, e.g. in rows of
+    **total_df** that only have gas data, are taken at the reference temperature.
+    """
+    if constants is None:
+        constants = EquilibriumConstants()
+    temperature = np.asarray(temperature,dtype=np.float64)
+    return constants.at(np.where(np.isnan(temperature),constants.reference_temperature,temperature))
+
+def iter_DIC_series(total_df,echem_time_df,volume=0.01,chunk_rows=1000000,pH_attribute='pH_right',timeline_index=None,
+                    constants=None,temperature_attribute=None):
+    """
+    Generator version of `calc_DIC_series()`. Yields the series for **chunk_rows** rows of **total_df** at a time, so
+    that the temporary arrays stay bounded for long datasets. The running charge is carried from one chunk to the next.
+
+    .. note::   Here is an example
+
+                .. code-block:: python
+
+                    for chunk in iter_DIC_series(total_df,time_df,chunk_rows=500000):
+                        chunk.to_csv('dic_series.csv',mode='a',header=(chunk.index[0]==total_df.index[0]))
+
+    Arguments and columns are the same as in `calc_DIC_series()`.
+    """
+    anchors,anchor_TA,anchor_pH = _cycle_TA_anchors(total_df,echem_time_df,pH_attribute,timeline_index,constants,temperature_attribute)
+    anchor_charge = np.full(len(anchors),np.nan)
+    charge = 0.0 #charge passed before the chunk
+    previous_time = None #time of the last echem sample before the chunk
+
+    for start in range(0,len(total_df),chunk_rows):
+        chunk = total_df.iloc[start:start+chunk_rows]
+        positions = np.arange(start,start+len(chunk))
+        #charge before each row, integrated as in calc_DIC and continued from the previous chunk
+        chunk_charge = charge+_echem_charge(chunk,initial_time=previous_time)
+        charge,chunk_charge = chunk_charge[-1],chunk_charge[:-1]
+        if chunk['Time'].notna().any():
+            previous_time = chunk['Time'].dropna().iloc[-1]
+        in_chunk = (anchors>=start)&(anchors<start+len(chunk))
+        anchor_charge[in_chunk] = chunk_charge[anchors[in_chunk]-start]
+
+        cycle = np.searchsorted(anchors,positions,side='right')
+        anchored = cycle>0
+        TA_val = np.full(len(chunk),np.nan)
+        TA_val[anchored] = anchor_TA[cycle[anchored]-1]+(chunk_charge[anchored]-anchor_charge[cycle[anchored]-1])/96485/volume
+
+        pH_measured = chunk[pH_attribute].to_numpy(dtype=np.float64,copy=True)
+        #at the anchors, the initial pH of calc_DIC (averaged over the previous 20 rows after the first cycle)
+        pH_measured[anchors[in_chunk]-start] = anchor_pH[in_chunk]
+        pCO2 = chunk['CO2 input right(abs val)'].to_numpy(dtype=np.float64)/(chunk['CO2 input right(abs val)'].to_numpy(dtype=np.float64)
+                                                                         +chunk['N2 input right(abs val)'].to_numpy(dtype=np.float64))
+        chunk_constants = _series_constants(constants,chunk[temperature_attribute]) if temperature_attribute else constants
+        co2aq = pCO2*_constant_values(chunk_constants)[3]
+        pH_theory = solve_pH(co2aq,TA_val,pH_guess=np.where(np.isnan(pH_measured),7.0,pH_measured),constants=chunk_constants)[0]
+
+        yield pd.DataFrame({'Datetime':chunk['Datetime'].to_numpy(),'Cycle':cycle,'pH_measured':pH_measured,'pH_theory':pH_theory,
+                            'co2aq':co2aq,'TA':TA_val,'DIC_TA':speciation_from_TA_pH(TA_val,pH_measured,chunk_constants)['DIC'],
+                            'DIC_eq':dic(co2aq,pH_measured,constants=chunk_constants),
+                            'DIC_theory':dic(co2aq,pH_theory,constants=chunk_constants)},index=chunk.index)
+
+def calc_DIC_series(total_df,echem_time_df,volume=0.01,chunk_rows=None,pH_attribute='pH_right',timeline_index=None,
+                    constants=None,temperature_attribute=None):
+
+    """
+    Calculates DIC \ :sub:`TA`\, DIC \ :sub:`eq`\, pH  \ :sub:`theory,eq`\ and DIC \ :sub:`theory,eq`\ for every row of the
+    echem_gas_dataframe(**total_df**), instead of only at the states of `calc_DIC()`. TA is anchored at the start of each
+    cycle as in state 3'i of `calc_DIC()` and follows the cumulative charge passed since then. co2aq follows the pCO2 set
+    by the mass flow controllers, assuming gas-solution equilibrium. At the rows of the states, the values are the ones
+    of `calc_DIC()`; in particular, the measured pH at the start of every cycle after the first is the average of the
+    previous 20 rows, as in state 3'i.
+
+    :type total_df: pd.DataFrame
+    :param total_df: A pandas dataframe, created by `utils.merge_echem_gas_df()` function, that contains echem and gas information
+
+    :type echem_time_df: pd.DataFrame
+    :param echem_time_df:  A pandas dataframe, created by `echem_method.find_time_period()` function, that contains the timing of the start and end of each echem process
+
+    :type volume: float
+    :param volume: Volume in litre. The volume of the electrolyte
+
+    :type chunk_rows: int
+    :param chunk_rows: If given, rows are processed **chunk_rows** at a time to bound the temporary memory. Use `iter_DIC_series()` to also avoid holding the whole result.
+
+    :type pH_attribute: string
+    :param pH_attribute: attribute of **total_df** used as the measured pH, e.g. 'pH_right' or 'fitted_pH_right'
+
+    :type timeline_index: timeline.TimelineIndex
+    :param timeline_index: index over total_df['Datetime'], see `calc_DIC()`
+
+    :type constants: EquilibriumConstants
+    :param constants: equilibrium constants. If None, the module constants are used.
+
+    :type temperature_attribute: string
+    :param temperature_attribute: attribute of **total_df** with the temperature in degree Celsius, usually 'Temperature'. If given, **constants** are evaluated at the temperature of every row (see `EquilibriumConstants.at()`); rows without temperature use the reference temperature.
+
+    :rtype: *pd.DataFrame*
+    :return: A dataset with the index of **total_df**
+
+        dataset['Datetime'] -> (*datetime64*): Datetime of the row\n
+        dataset['Cycle'] -> (*int*): The cycle number, 0 before the TA of the first cycle is anchored\n
+        dataset['pH_measured'] -> (*float*): The measured pH value, or the initial pH of `calc_DIC()` at the start of each cycle\n
+        dataset['pH_theory'] -> (*float*): The theoretical pH value given pCO2 and TA\n
+        dataset['co2aq'] -> (*float*): Aqueous co2 concentration in equilibrium with the pCO2 set by the mass flow controllers\n
+        dataset['TA'] -> (*float*): The total alkalinity concentration in Molar, NaN before the first cycle\n
+        dataset['DIC_TA'] -> (*float*): DIC \ :sub:`TA`\ value in Molar, from TA and measured pH\n
+        dataset['DIC_eq'] -> (*float*): DIC \ :sub:`eq`\ value in Molar, from measured pH and co2aq\n
+        dataset['DIC_theory'] -> (*float*): DIC \ :sub:`theory,eq`\ value in Molar, from TA and theoretical pH\n
+    """
+    chunks = iter_DIC_series(total_df,echem_time_df,volume,chunk_rows or max(len(total_df),1),pH_attribute,timeline_index,
+                             constants,temperature_attribute)
+    return pd.concat(list(chunks))
+
+
+def _percentile_columns(samples,percentiles):
+    """
+    {name_p<percentile>: values} for a dictionary of (samples, rows) arrays.
+    """
+    columns = {}
+    for name,values in samples.items():
+        bands = np.nanpercentile(values,percentiles,axis=0)
+        for percentile,band in zip(percentiles,bands):
+            columns['{}_p{:g}'.format(name,percentile)] = band
+    return columns
+
+def calc_DIC_uncertainty(total_df,echem_time_df,gas_change_time_df,n_samples=10000,outgas_shift=20,volume=0.01,volume_sigma=0.0001,
+                         pH_calibration={'slope':-17.4,'intercept':7.728},pH_slope_sigma=0.2,pH_intercept_sigma=0.02,
+                         henry_sigma=0.001,pco2_sigma=0.01,percentiles=(2.5,50,97.5),seed=None,timeline_index=None,constants=None):
+    """
+    Monte Carlo uncertainty of the values of `calc_DIC()` and of the capture and outgas Delta_DIC of
+    `utils.merge_amount_dic_df()`. **n_samples** sets of inputs are drawn from normal distributions around the nominal
+    pH calibration, electrolyte volume, Henry's constant and pCO2, and every state of a cycle is evaluated for all
+    samples at once with `speciation_from_TA_pH()` and `solve_pH()`. Each sample is one possible set of systematic
+    errors, so it is kept for all states and cycles, and the Delta_DIC bands account for the correlation between states.
+
+    The measured pH is recalibrated as pH = slope*E+intercept, where E is recovered from the recorded pH with
+    **pH_calibration**, the calibration used by `echem_methods.read_echem()`.
+
+    .. note::   Here is an example
+
+                .. code-block:: python
+
+                    uncertainty = calc_DIC_uncertainty(total_df,time_df,change_gas_df,n_samples=10000,seed=0)
+                    uncertainty['cycles'][['Cycle','Delta_DIC_TA_outgas_p2.5','Delta_DIC_TA_outgas_p97.5']]
+
+    :type total_df: pd.DataFrame
+    :param total_df: A pandas dataframe, created by `utils.merge_echem_gas_df()` function, that contains echem and gas information
+
+    :type echem_time_df: pd.DataFrame
+    :param echem_time_df:  A pandas dataframe, created by `echem_method.find_time_period()` function, that contains the timing of the start and end of each echem process
+
+    :type gas_change_time_df: pd.DataFrame
+    :param gas_change_time_df: A pandas dataframe, created by 'gas_methods.find_gas_change_time()' function, that contains the timing of when atmosphere CO2 is changed
+
+    :type n_samples: int
+    :param n_samples: Number of Monte Carlo samples
+
+    :type outgas_shift: int
+    :param outgas_shift: Time in seconds. Offsets inaccurate timing in **echem_time_df** or **gas_change_time_df**
+
+    :type volume: float
+    :param volume: Volume in litre. The volume of the electrolyte
+
+    :type volume_sigma: float
+    :param volume_sigma: Standard deviation of **volume** in litre
+
+    :type pH_calibration: dict
+    :param pH_calibration: calibration of the pH probe, {'slope':slope,'intercept':intercept}
+
+    :type pH_slope_sigma: float
+    :param pH_slope_sigma: Standard deviation of the calibration slope
+
+    :type pH_intercept_sigma: float
+    :param pH_intercept_sigma: Standard deviation of the calibration intercept in pH units
+
+    :type henry_sigma: float
+    :param henry_sigma: Standard deviation of Henry's constant in M/bar
+
+    :type pco2_sigma: float
+    :param pco2_sigma: Relative standard deviation of the pCO2 set by the mass flow controllers
+
+    :type percentiles: tuple
+    :param percentiles: Percentiles of the bands, between 0 and 100
+
+    :type seed: int
+    :param seed: Seed of the random number generator, for reproducible bands
+
+    :type timeline_index: timeline.TimelineIndex
+    :param timeline_index: index over total_df['Datetime'], see `calc_DIC()`
+
+    :type constants: EquilibriumConstants
+    :param constants: nominal equilibrium constants. If None, the module constants are used.
+
+    :rtype: *dict*
+    :return: a dictionary with two datasets, with one column per output and percentile, e.g. 'DIC_TA_p2.5':
+
+        dict['states'] -> (*pd.DataFrame*): ['Cycle'], ['State'] and ['index'] as in `calc_DIC()`, and bands of ['pH_measured'], ['pH_theory'], ['TA'], ['DIC_TA'], ['DIC_eq'], ['DIC_theory'], ['Delta_DIC_TA'], ['Delta_DIC_eq'] and ['Delta_DIC_theory']\n
+        dict['cycles'] -> (*pd.DataFrame*): ['Cycle'] and bands of Delta_DIC_<TA, eq or theory>_<capture, outgas or effective> as in `utils.merge_amount_dic_df()`\n
+    """
+    k1,k2,kw,henry = _constant_values(constants)
+    rng = np.random.default_rng(seed)
+    slope = pH_calibration['slope']+pH_slope_sigma*rng.standard_normal((n_samples,1))
+    intercept = pH_calibration['intercept']+pH_intercept_sigma*rng.standard_normal((n_samples,1))
+    volume_samples = volume+volume_sigma*rng.standard_normal((n_samples,1))
+    henry_samples = henry+henry_sigma*rng.standard_normal((n_samples,1))
+    pco2_error = 1+pco2_sigma*rng.standard_normal((n_samples,1))
+    sample_constants = EquilibriumConstants(k1,k2,kw,henry_samples)
+
+    if timeline_index is None:
+        timeline_index = timeline.TimelineIndex(total_df)
+    states = timeline_index.map_states(echem_time_df,gas_change_time_df,outgas_shift)
+    charge = _echem_charge(total_df)
+    state_names = ['3\'i','1','1\'','3','3\'f']
+
+    state_columns = {}
+    cycle_columns = {}
+    cycle_array,states_array,index_array = [],[],[]
+    for i in range(len(echem_time_df)):
+        positions = np.array([states[(i+1,state)] for state in state_names])
+        entries = total_df.iloc[positions]
+        pH_nominal = entries['pH_right'].to_numpy(dtype=np.float64,copy=True)
+        if i > 0:
+            #previous 20 rows for calculating a more reliable initial pH, as in calc_DIC
+            pH_nominal[0] = np.average(total_df.iloc[positions[0]-20:positions[0]]['pH_right'])
+        pCO2 = (entries['CO2 input right(abs val)']/(entries['CO2 input right(abs val)']+entries['N2 input right(abs val)'])).to_numpy(dtype=np.float64)
+
+        #(samples, states) arrays
+        pH_measured = slope*(pH_nominal-pH_calibration['intercept'])/pH_calibration['slope']+intercept
+        co2aq = henry_samples*np.clip(pCO2*pco2_error,0,None)
+        initial_TA = TA(co2aq[:,:1],pH_measured[:,:1],constants=sample_constants)
+        TA_val = initial_TA+(charge[positions]-charge[positions[0]])/96485/volume_samples
+        pH_theory = solve_pH(co2aq,TA_val,pH_guess=pH_measured,constants=sample_constants)[0]
+        pH_theory[:,0] = pH_measured[:,0]
+        DIC_TA = speciation_from_TA_pH(TA_val,pH_measured,sample_constants)['DIC']
+        DIC_eq = dic(co2aq,pH_measured,constants=sample_constants)
+        DIC_theory = dic(co2aq,pH_theory,constants=sample_constants)
+        samples = {'pH_measured':pH_measured,'pH_theory':pH_theory,'TA':TA_val,'DIC_TA':DIC_TA,'DIC_eq':DIC_eq,'DIC_theory':DIC_theory}
+        for name in ['TA','eq','theory']:
+            samples['Delta_DIC_'+name] = np.diff(samples['DIC_'+name],axis=1,prepend=samples['DIC_'+name][:,:1])
+        for name,band in _percentile_columns(samples,percentiles).items():
+            state_columns.setdefault(name,[]).append(band)
+
+        #capture, outgas and effective Delta_DIC of utils.merge_amount_dic_df, per cycle
+        capture_outgas = {}
+        for name in ['TA','eq','theory']:
+            delta = np.abs(samples['Delta_DIC_'+name])
+            capture_outgas['Delta_DIC_{}_capture'.format(name)] = delta[:,1:2]
+            capture_outgas['Delta_DIC_{}_outgas'.format(name)] = delta[:,3:4]
+            capture_outgas['Delta_DIC_{}_effective'.format(name)] = delta[:,3:4]-delta[:,2:3]
+        for name,band in _percentile_columns(capture_outgas,percentiles).items():
+            cycle_columns.setdefault(name,[]).append(band)
+
+        cycle_array.extend([i+1]*len(state_names))
+        states_array.extend(state_names)
+        index_array.extend(positions)
+
+    state_df = pd.DataFrame({'Cycle':cycle_array,'State':states_array,'index':index_array})
+    for name,bands in state_columns.items():
+        state_df[name] = np.concatenate(bands)
+    cycle_df = pd.DataFrame({'Cycle':np.arange(1,len(echem_time_df)+1)})
+    for name,bands in cycle_columns.items():
+        cycle_df[name] = np.concatenate(bands)
+    return {'states':state_df,'cycles':cycle_df}
+
 def create_theoretical_dic_pH_array(min_TA = 0,max_TA = 0.2,TA_points=100,capture_pco2 = 0.1,outgas_pco2=1.0,
                                     pco2_points=100, deacidification_pH_guess = 7.5,
                                     acidification_pH_guess = 7.5,pH_low_to_high_guess=7.5,
-                                   pH_high_to_low_guess=7.5):
+                                   pH_high_to_low_guess=7.5,solver="fsolve"):
     
     """
     Create theoretical DIC and pH arrays given a max and min total alkalinity
@@ -324,6 +1097,9 @@ def create_theoretical_dic_pH_array(min_TA = 0,max_TA = 0.2,TA_points=100,captur
     :param pH_high_to_low_guess: MUST BE A FLOAT. Initial guess of pH in gas change fomr high partial pressure to low partial pressure
                                  for scipy.fsolve.
 
+    :type solver: string
+    :param solver: "fsolve" solves every point separately. "vectorized" solves each array at once with `solve_pH()` (the pH guesses are not needed) and returns np.ndarray instead of lists.
+
     :rtype: *dict*
     :return: a dictionary containing TA, DIC, pH array for various processes:
 
@@ -350,12 +1126,23 @@ def create_theoretical_dic_pH_array(min_TA = 0,max_TA = 0.2,TA_points=100,captur
     dic_deacidification_array = []
     dic_acidification_array = []
 
-    change_gas_array = np.linspace(co2aq_capture,co2aq_outgas,100)
+    change_gas_array = np.linspace(co2aq_capture,co2aq_outgas,pco2_points)
 
     pH_low_to_high_array = []
     pH_high_to_low_array = []
     dic_low_to_high_array = []
     dic_high_to_low_array = []
+
+    if solver == "vectorized":
+        pH_deacidification_array = solve_pH(co2aq_capture,alkalinity_array)[0]
+        pH_acidification_array = solve_pH(co2aq_outgas,alkalinity_array)[0]
+        pH_low_to_high_array = solve_pH(change_gas_array,alkalinity_array[-1])[0]
+        pH_high_to_low_array = solve_pH(change_gas_array,alkalinity_array[0])[0]
+        return {"alkalinity":alkalinity_array,"change_gas":change_gas_array,"pH_deacidification":pH_deacidification_array
+               ,"pH_acidification":pH_acidification_array,"dic_deacidification":dic(co2aq_capture,pH_deacidification_array)
+               ,"dic_acidification":dic(co2aq_outgas,pH_acidification_array),"pH_low_to_high":pH_low_to_high_array
+               ,"pH_high_to_low":pH_high_to_low_array,"dic_low_to_high":dic(change_gas_array,pH_low_to_high_array)
+               ,"dic_high_to_low":dic(change_gas_array,pH_high_to_low_array),"capture_pco2":capture_pco2,"outgas_pco2":outgas_pco2}
     
     #Calculate equilibrium pH and DIC at fixed pCO2 based on varying TA
     for i in range(len(alkalinity_array)):
@@ -396,6 +1183,164 @@ def create_theoretical_dic_pH_array(min_TA = 0,max_TA = 0.2,TA_points=100,captur
            ,"dic_high_to_low":dic_high_to_low_array,"capture_pco2":capture_pco2,"outgas_pco2":outgas_pco2}
 
 
+def _theoretical_surface_block(co2aq_array,TA_block,chunk_rows,constants=None):
+    """
+    Solves pH for the rows of **TA_block** against **co2aq_array**, **chunk_rows** TA values at a time. Each chunk is
+    warm-started from the last row of the previous one, since pH changes little between neighbouring TA values.
+    """
+    pH = np.empty((len(TA_block),len(co2aq_array)))
+    converged = np.empty(pH.shape,dtype=bool)
+    pH_guess = 7.0
+    for start in range(0,len(TA_block),chunk_rows):
+        rows = slice(start,start+chunk_rows)
+        pH[rows],converged[rows] = solve_pH(co2aq_array,TA_block[rows,None],pH_guess,constants=constants)
+        pH_guess = np.where(converged[rows][-1],pH[rows][-1],7.0)
+    return pH,converged
+
+def create_theoretical_dic_pH_surface(min_TA=0,max_TA=0.2,TA_points=1000,min_pco2=0.1,max_pco2=1.0,pco2_points=1000,
+                                      chunk_rows=100,n_jobs=1,constants=None):
+    """
+    Create theoretical pH and DIC surfaces over a TA x pCO2 grid, the 2-D counterpart of
+    `create_theoretical_dic_pH_array()`. The grid is solved with the vectorized `solve_pH()` in blocks of TA rows,
+    which also bounds the memory used for grids with millions of nodes.
+
+    .. note::   Here is an example
+
+                .. code-block:: python
+
+                    surface = create_theoretical_dic_pH_surface(0,0.2,1000,0.1,1.0,1000,n_jobs=4)
+                    plt.contourf(surface['pco2'],surface['alkalinity'],surface['pH'])
+
+    :type min_TA: float
+    :param min_TA: Minimum total alkalinity in Molar
+
+    :type max_TA: float
+    :param max_TA: Maximum total alkalinity in Molar
+
+    :type TA_points: int
+    :param TA_points: Number of points in the TA array. Used in np.linspace
+
+    :type min_pco2: float
+    :param min_pco2: Minimum CO2 partial pressure in bar
+
+    :type max_pco2: float
+    :param max_pco2: Maximum CO2 partial pressure in bar
+
+    :type pco2_points: int
+    :param pco2_points: Number of points in the pCO2 array. Used in np.linspace
+
+    :type chunk_rows: int
+    :param chunk_rows: Number of TA rows solved at once. Each chunk is warm-started from the previous one.
+
+    :type n_jobs: int
+    :param n_jobs: number of worker processes. If larger than 1, the TA rows are split into blocks that are solved on a process pool.
+
+    :type constants: EquilibriumConstants
+    :param constants: equilibrium constants with scalar values. If None, the module constants are used.
+
+    :rtype: *dict*
+    :return: a dictionary containing:
+
+        dict['alkalinity'] -> (*np.ndarray*): TA array\n
+        dict['pco2'] -> (*np.ndarray*): pCO2 array\n
+        dict['pH'] -> (*np.ndarray*): pH of shape (TA_points, pco2_points)\n
+        dict['dic'] -> (*np.ndarray*): DIC of shape (TA_points, pco2_points)\n
+        dict['converged'] -> (*np.ndarray*): False where `solve_pH()` did not converge\n
+    """
+    alkalinity_array = np.linspace(min_TA,max_TA,TA_points)
+    pco2_array = np.linspace(min_pco2,max_pco2,pco2_points)
+    co2aq_array = _constant_values(constants)[3]*pco2_array
+
+    if n_jobs > 1:
+        blocks = np.array_split(alkalinity_array,min(n_jobs,TA_points))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(_theoretical_surface_block,[co2aq_array]*len(blocks),blocks,[chunk_rows]*len(blocks),
+                                        [constants]*len(blocks)))
+        pH_array = np.concatenate([pH for pH,_ in results])
+        converged = np.concatenate([block_converged for _,block_converged in results])
+    else:
+        pH_array,converged = _theoretical_surface_block(co2aq_array,alkalinity_array,chunk_rows,constants)
+
+    return {"alkalinity":alkalinity_array,"pco2":pco2_array,"pH":pH_array,"dic":dic(co2aq_array,pH_array,constants=constants),
+            "converged":converged}
+
+def _pH_TA_integral(co2aq,TA_start,TA_end,pH_start,pH_end,constants=None):
+    """
+    ln(10) times the integral of pH over TA from **TA_start** to **TA_end** at fixed **co2aq**. TA(pH) has the
+    antiderivative G(pH)/ln(10) with G = (kw+co2aq*k1)/[H+]+co2aq*k1*k2/[H+]^2+[H+], so integrating by parts gives
+    ln(10)*[TA*pH]-[G] without quadrature.
+    """
+    k1,k2,kw,_ = _constant_values(constants)
+    G = lambda pH: (kw+co2aq*k1)*10**pH+co2aq*k1*k2*10**(2*pH)+10**-pH
+    return np.log(10)*(TA_end*pH_end-TA_start*pH_start)-(G(pH_end)-G(pH_start))
+
+def sweep_theoretical_dic_cycle(min_TA,max_TA,capture_pco2,outgas_pco2,temperature=298.15,constants=None):
+    """
+    Ideal DIC cycle metrics for many operating points at once. The cycle is the one drawn by
+    `plotting.plot_theoretical_dic_pH_TA()`: deacidification from **min_TA** to **max_TA** at **capture_pco2**, gas change
+    to **outgas_pco2**, acidification back to **min_TA** and gas change back to **capture_pco2**, always at equilibrium.
+    Only the four corners of the cycle are solved, with the vectorized `solve_pH()`, and the work integral is evaluated
+    in closed form, so a million operating points take a few seconds.
+
+    The minimum work is RT*ln(10)*integral((pH_deacidification-pH_acidification)dTA) from **min_TA** to **max_TA**, the
+    work of moving the protons between the acidified and deacidified electrolyte reversibly.
+
+    .. note::   Here is an example
+
+                .. code-block:: python
+
+                    min_TA,max_TA,capture_pco2 = np.meshgrid(np.linspace(0,0.1,100),np.linspace(0.2,1,100),np.linspace(0.01,0.5,100),indexing='ij')
+                    sweep = sweep_theoretical_dic_cycle(min_TA,max_TA,capture_pco2,1.0)
+                    sweep['min_work_per_co2'].min()
+
+    :type min_TA: float or np.ndarray
+    :param min_TA: Minimum total alkalinity or alkalinity in the discharged form in Molar
+
+    :type max_TA: float or np.ndarray
+    :param max_TA: Maximum total alkalinity or alkalinity in the charged form in Molar
+
+    :type capture_pco2: float or np.ndarray
+    :param capture_pco2: CO2 partial pressure in bar during capture process
+
+    :type outgas_pco2: float or np.ndarray
+    :param outgas_pco2: CO2 partial pressure in bar during outgas process
+
+    :type temperature: float
+    :param temperature: Temperature in K, used for RT in the minimum work
+
+    :type constants: EquilibriumConstants
+    :param constants: equilibrium constants, e.g. `EquilibriumConstants().at(temperature-273.15)`. If None, the module constants are used.
+
+    :rtype: *dict*
+    :return: a dictionary of arrays with the broadcast shape of the inputs:
+
+        dict['dic_swing'] -> (*np.ndarray*): CO2 captured and released per cycle in Molar, DIC at (max_TA, capture_pco2) minus DIC at (min_TA, outgas_pco2)\n
+        dict['co2_per_electron'] -> (*np.ndarray*): **dic_swing** divided by the TA change, i.e. mol CO2 per mol electrons\n
+        dict['min_work'] -> (*np.ndarray*): minimum cycle work in J per liter of electrolyte\n
+        dict['min_work_per_co2'] -> (*np.ndarray*): minimum cycle work in J per mol CO2, NaN where **dic_swing** is not positive\n
+        dict['converged'] -> (*np.ndarray*): False where the pH of a corner did not converge\n
+    """
+    min_TA,max_TA,capture_pco2,outgas_pco2 = np.broadcast_arrays(*[np.asarray(value,dtype=np.float64) for value in
+                                                                   [min_TA,max_TA,capture_pco2,outgas_pco2]])
+    co2aq_capture = _constant_values(constants)[3]*capture_pco2
+    co2aq_outgas = _constant_values(constants)[3]*outgas_pco2
+
+    pH_capture_min,converged_capture_min = solve_pH(co2aq_capture,min_TA,constants=constants)
+    pH_capture_max,converged_capture_max = solve_pH(co2aq_capture,max_TA,constants=constants)
+    pH_outgas_min,converged_outgas_min = solve_pH(co2aq_outgas,min_TA,constants=constants)
+    pH_outgas_max,converged_outgas_max = solve_pH(co2aq_outgas,max_TA,constants=constants)
+
+    dic_swing = dic(co2aq_capture,pH_capture_max,constants=constants)-dic(co2aq_outgas,pH_outgas_min,constants=constants)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        co2_per_electron = dic_swing/(max_TA-min_TA)
+    min_work = 8.314*temperature*(_pH_TA_integral(co2aq_capture,min_TA,max_TA,pH_capture_min,pH_capture_max,constants)
+                                  -_pH_TA_integral(co2aq_outgas,min_TA,max_TA,pH_outgas_min,pH_outgas_max,constants))
+    with np.errstate(divide='ignore',invalid='ignore'):
+        min_work_per_co2 = np.where(dic_swing>0,min_work/dic_swing,np.nan)
+
+    return {"dic_swing":dic_swing,"co2_per_electron":co2_per_electron,"min_work":min_work,"min_work_per_co2":min_work_per_co2,
+            "converged":converged_capture_min&converged_capture_max&converged_outgas_min&converged_outgas_max}
+
 def TA_co2aq_wrapper(pH,solve_value=0):
     """A function wrapper used when using newton_krylov solver solving for co2aq given **pH** and **TA**, which doesn't take additional arguments
     
@@ -422,17 +1367,13 @@ def calc_dic_TApH(pH_meas,co2aq_guess=400./1000000.*0.035,TA_val=1.0):
     :type pH_meas: float
     :param pH_meas: pH value
     :type co2aq_guess: float
-    :param co2aq_guess: estimated aqueous CO2 concentration
+    :param co2aq_guess: not used anymore, co2aq is calculated in closed form by `co2aq_from_TA_pH()`. Kept for compatibility.
     :type TA_val: float
     :param TA_val: TA concentration
     
-    :rtype: *func*
-    :return: DIC value
+    :rtype: *float*
+    :return: DIC value. Works element-wise on arrays of **pH_meas** and **TA_val**
 
     
     """
-    co2aq_func = TA_co2aq_wrapper(pH_meas,solve_value = TA_val)
-    co2aq_theory = fsolve(co2aq_func,co2aq_guess)
-    dic_TApH = dic(co2aq_theory,pH_meas)
-    
-    return dic_TApH
+    return speciation_from_TA_pH(TA_val,pH_meas)['DIC']
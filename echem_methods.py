@@ -5,6 +5,13 @@ import datetime
 import csv
 import sys
 import glob
+import io
+import re
+import os
+import json
+import hashlib
+import mmap
+import concurrent.futures
 from matplotlib.ticker import MultipleLocator
 from scipy.fft import fft,ifft
 import pickle
@@ -17,16 +24,20 @@ from tqdm import tqdm
 def find_date_time(file):
     
     ''' 
-    Reads a Gamry file, finds its creation datetime, and returns a datetime variable.
+    Reads a Gamry file, finds its creation datetime, and returns a datetime variable. Reading stops as soon as the
+    DATE and TIME header fields are found.
     
-    :type file: string
-    :param file: the address of the file
+    :type file: _io.TextIOWrapper object
+    :param file: opened Gamry file
     
     :rtype: *datetime.datetime*
     :return: **starting_date_time**: the datetime that the Gamry file was created(when this electrochemical method starts). 
 
     '''
-    for row in file:
+    year = None
+    hour = None
+    #readline rather than iteration keeps file.tell() usable for the caller
+    for row in iter(file.readline,''):
         if row.startswith('DATE'):
             year = int(row.split()[2].split('/')[2])
             month = int(row.split()[2].split('/')[0])
@@ -35,11 +46,189 @@ def find_date_time(file):
             hour = int(row.split()[2].split(':')[0])
             minute = int(row.split()[2].split(':')[1])
             second = int(row.split()[2].split(':')[2])
+        #DATE and TIME are header fields, the data block does not need to be read
+        if year is not None and hour is not None:
+            break
         
     starting_date_time = datetime.datetime(year,month,day,hour,minute,second)
     return starting_date_time
 
-def analyze_gamry_file(file,starting_date_time,pH_right_calibration={'slope':-17.4,'intercept':7.728},pH_left_calibration={'slope':-17.602,'intercept':7.1728}):
+#Column positions of the quantities used in a Gamry data block. Rows start with a tab, so
+#column 0 of a tab-separated read is empty and 'Pt' sits in column 1.
+GAMRY_DATA_COLUMNS = {'Delta_T_s':2,'Voltage':3,'Current':4,'Temperature':9,'pH_left':12,'pH_right':18}
+
+def _find_data_block(file):
+    '''
+    Advances an opened Gamry file to the first row of its data block (the row after the column names and units
+    that follow the CURVE TABLE line) and returns the number of data rows declared by the CURVE TABLE line.
+
+    :type file: _io.TextIOWrapper object
+    :param file: opened Gamry file
+
+    :rtype: *int*
+    :return: **nrows**: number of rows in the data block
+    '''
+    for row in iter(file.readline,''):
+        if row.startswith('CURVE'):
+            nrows = int(row.split()[2])
+            #skip the column name row and the unit row
+            file.readline()
+            file.readline()
+            return nrows
+    raise ValueError('No CURVE TABLE found in '+str(file.name))
+
+def _read_data_block(file,nrows):
+    '''
+    Reads **nrows** rows of a Gamry data block, starting at the current position of **file**, into float64 NumPy columns.
+
+    :type file: _io.TextIOWrapper object
+    :param file: opened Gamry file positioned at the first data row by `_find_data_block`
+
+    :type nrows: int
+    :param nrows: number of rows in the data block. If None, everything up to the end of **file** is read.
+
+    :rtype: *dict*
+    :return: a dictionary of NumPy arrays keyed by the names in **GAMRY_DATA_COLUMNS**
+    '''
+    block = pd.read_csv(file,sep='\t',header=None,nrows=nrows,usecols=list(GAMRY_DATA_COLUMNS.values()),
+                        dtype=np.float64,engine='c')
+    return {name:block[column].to_numpy() for name,column in GAMRY_DATA_COLUMNS.items()}
+
+def _gamry_file_labels(name):
+    '''
+    Returns the cycle number and the echem process encoded in a Gamry file name, e.g. (3,'Outgas') for '.../Outgas_#3.DTA'.
+    '''
+    file_name = name.split('/')[-1]
+    return int(file_name.split('_#')[1].split('.')[0]),file_name.split('_#')[0]
+
+def _calibrate_pH_columns(columns,pH_right_calibration,pH_left_calibration):
+    '''
+    Converts the raw pH probe voltages in **columns** into pH in place, using the linear probe calibrations.
+    '''
+    columns['pH_left'] = columns['pH_left']*pH_left_calibration['slope']+pH_left_calibration['intercept']
+    columns['pH_right'] = columns['pH_right']*pH_right_calibration['slope']+pH_right_calibration['intercept']
+
+def _echem_process_categories(echem_process):
+    '''
+    Returns the categories of ['Echem_process'] for a file of **echem_process**: **ECHEM_PROCESSES**, followed by
+    **echem_process** if it is another process, e.g. for a file named 'CV_#1.DTA'.
+    '''
+    return ECHEM_PROCESSES if echem_process in ECHEM_PROCESSES else ECHEM_PROCESSES+[echem_process]
+
+def _gamry_frame(columns,starting_date_time,cycle_number,echem_process):
+    '''
+    Assembles calibrated, fitted Gamry columns into the dataset layout returned by **analyze_gamry_file**.
+    '''
+    t_array = columns['Delta_T_s']
+    categories = _echem_process_categories(echem_process)
+    return pd.DataFrame({'Delta_T_s':t_array,'Cycle_number':np.full(len(t_array),cycle_number,dtype=np.int16),
+                         'Echem_process':pd.Categorical.from_codes(np.full(len(t_array),categories.index(echem_process),dtype=np.int8),
+                                                                   categories=categories),
+                         'Time':pd.Timestamp(starting_date_time)+pd.to_timedelta(t_array,unit='s'),
+                         'Voltage':columns['Voltage'],'Current':columns['Current'],'Capacity':columns['Capacity'],
+                         'pH_left':columns['pH_left'],'pH_right':columns['pH_right'],
+                         'fitted_pH_left':columns['fitted_pH_left'],'fitted_pH_right':columns['fitted_pH_right'],
+                         'Temperature':columns['Temperature']})
+
+#Options of smooth_pH used when they are not given. Windows are in data points.
+PH_SMOOTHING_DEFAULTS = {'polynomial':{'degree':6},'savgol':{'window':101,'polyorder':3},
+                         'median':{'window':101},'hampel':{'window':101,'n_sigma':3},'none':{}}
+
+def smooth_pH(t_array,pH_array,method='polynomial',**options):
+    '''
+    Removes glitches from the pH data of one half cycle.
+
+    :type t_array: np.ndarray
+    :param t_array: time in seconds since the start of the half cycle
+
+    :type pH_array: np.ndarray
+    :param pH_array: calibrated pH data
+
+    :type method: string
+    :param method: smoothing method, options are updated from **PH_SMOOTHING_DEFAULTS**\n
+            'polynomial': least-squares polynomial of degree **degree** in time. Time is mapped to [-1,1] before fitting, which keeps long files well conditioned.\n
+            'savgol': Savitzky-Golay filter over **window** points with polynomial order **polyorder**\n
+            'median': centered rolling median over **window** points\n
+            'hampel': Hampel filter. Points further than **n_sigma** scaled median absolute deviations from the centered rolling median over **window** points are replaced by that median.\n
+            'none': no smoothing, the pH data is returned as is
+
+    :rtype: *np.ndarray*
+    :return: smoothed pH data. Series too short for the method are returned unsmoothed.
+    '''
+    if method not in PH_SMOOTHING_DEFAULTS:
+        raise ValueError('Unknown pH smoothing method {}, use one of {}'.format(method,list(PH_SMOOTHING_DEFAULTS)))
+    options = {**PH_SMOOTHING_DEFAULTS[method],**options}
+    pH_array = np.asarray(pH_array,dtype=np.float64)
+    n = len(pH_array)
+
+    if method == 'polynomial':
+        if n <= options['degree']:
+            return pH_array.copy()
+        return np.polynomial.Polynomial.fit(t_array,pH_array,options['degree'])(t_array)
+    if method == 'savgol':
+        window = min(options['window'],n if n%2 else n-1)
+        if window <= options['polyorder']:
+            return pH_array.copy()
+        return savgol_filter(pH_array,window,options['polyorder'])
+    if method in ['median','hampel']:
+        pH_series = pd.Series(pH_array)
+        rolling_median = pH_series.rolling(options['window'],center=True,min_periods=1).median()
+        if method == 'median':
+            return rolling_median.to_numpy()
+        deviation = (pH_series-rolling_median).abs()
+        scaled_mad = 1.4826*deviation.rolling(options['window'],center=True,min_periods=1).median()
+        return np.where(deviation>options['n_sigma']*scaled_mad,rolling_median,pH_array)
+    return pH_array.copy()
+
+def _smooth_pH_columns(columns,smoothing):
+    '''
+    Adds the fitted pH columns to the calibrated columns of one Gamry file. If **smoothing** is None they are left empty (NaN).
+    '''
+    t_array = columns['Delta_T_s']
+    for side in ['left','right']:
+        if smoothing is None:
+            columns['fitted_pH_'+side] = np.full(len(t_array),np.nan)
+        else:
+            columns['fitted_pH_'+side] = smooth_pH(t_array,columns['pH_'+side],smoothing)
+
+def smooth_echem_pH(dataset,method='polynomial',**options):
+    '''
+    Recomputes ['fitted_pH_left'] and ['fitted_pH_right'] of a dataset from **read_echem** (or **analyze_gamry_file**)
+    with **smooth_pH**, file by file. Reading with smoothing=None and smoothing afterwards avoids paying for a fit
+    that is not used, and allows trying methods and options without parsing the Gamry files again.
+
+    .. note::   Here is an example
+
+                .. code-block:: python
+
+                    echem_df = read_echem(electrochem_path,smoothing=None)
+                    echem_df = smooth_echem_pH(echem_df,'hampel',window=301)
+
+    :type dataset: pd.DataFrame
+    :param dataset: dataset with the attributes ['Cycle_number'], ['Echem_process'], ['Delta_T_s'], ['pH_left'] and ['pH_right']
+
+    :type method: string
+    :param method: smoothing method, see **smooth_pH**
+
+    :rtype: *pd.DataFrame*
+    :return: **dataset**, with updated ['fitted_pH_left'] and ['fitted_pH_right']
+    '''
+    #each Gamry file is a contiguous run of rows with the same cycle number and process
+    cycle_numbers = dataset['Cycle_number'].to_numpy()
+    echem_processes = dataset['Echem_process'].to_numpy()
+    file_starts = np.flatnonzero((cycle_numbers[1:]!=cycle_numbers[:-1])|(echem_processes[1:]!=echem_processes[:-1]))+1
+    bounds = np.concatenate(([0],file_starts,[len(dataset)]))
+
+    t_array = dataset['Delta_T_s'].to_numpy(dtype=np.float64)
+    for side in ['left','right']:
+        pH_array = dataset['pH_'+side].to_numpy(dtype=np.float64)
+        fitted = np.empty(len(dataset))
+        for start,end in zip(bounds[:-1],bounds[1:]):
+            fitted[start:end] = smooth_pH(t_array[start:end],pH_array[start:end],method,**options)
+        dataset['fitted_pH_'+side] = fitted.astype(dataset['pH_'+side].dtype)
+    return dataset
+
+def analyze_gamry_file(file,starting_date_time,pH_right_calibration={'slope':-17.4,'intercept':7.728},pH_left_calibration={'slope':-17.602,'intercept':7.1728},smoothing='polynomial'):
     '''    
     Reads a Gamry file and the starting time of the first file (e.g. the time of the creation or the last time point of previous half cycle). Returns a dataset with continuous Time, Voltage, Current, pH and fitted pH for a half-cycle.
 
@@ -54,15 +243,17 @@ def analyze_gamry_file(file,starting_date_time,pH_right_calibration={'slope':-17
 
     :type pH_left_calibration: dict
     :param pH_left_calibration: dictionary that contains the slope of intercept information of the left pH probe calibration
-   
+
+    :type smoothing: string
+    :param smoothing: method used by **smooth_pH** for the fitted pH. If None, the fitted pH columns are left empty (NaN) and no smoothing is computed.
     
     :rtype: *pd.DataFrame*
     :return: **dataset** a dataset with continuous Time, Voltage, Current, pH and fitted pH for a half-cycle.
             dataset -> pandas.DataFrame: a dataset contains the following attributes\n
             dataset['Delta_T_s'] -> float: time in seconds since the start of the process\n
-            dataset['Time'] -> datetime.datetime: datetime of the current datum point\n
-            dataset['Cycle_number'] -> int: current cycle number\n
-            dataset['Echem_process'] -> str: PWRCHARGE refers to charge and PWRDISCHARGE refers to discharge\n
+            dataset['Time'] -> datetime64[ns]: datetime of the current datum point\n
+            dataset['Cycle_number'] -> int16: current cycle number\n
+            dataset['Echem_process'] -> category: PWRCHARGE refers to charge and PWRDISCHARGE refers to discharge, categories are **ECHEM_PROCESSES**, followed by the process of the file if it is another one\n
             dataset['Voltage'] -> float: voltage data in V\n
             dataset['Current'] -> float: current data in A\n
             dataset['Capacity'] -> float: capacity in Coulomb\n
@@ -71,74 +262,424 @@ def analyze_gamry_file(file,starting_date_time,pH_right_calibration={'slope':-17
             dataset['fitted_pH'] -> float: fitted pH data. Fluctuations were removed.\n
 
     '''
-    indicator = False #for indicating row # is not correct yet
-    t_array = []
-    pH_array_left = []
-    fitted_pH_array_left = []
-    pH_array_right = []
-    fitted_pH_array_right = []
-    voltage_array = []
-    current_array = []
-    total_time_array = []
-    temperature_array = []
-    cycle_number_array = []
-    echem_process_array = []
-    capacity_array = []
-    cycle_number = int(file.name.split('/')[-1].split('_#')[1].split('.')[0])
-    echem_process = file.name.split('/')[-1].split('_#')[0]
-    for row in file:
-        #finds the first row where actual data is recorded
-        if row.startswith('	0'):
-            indicator = True
-
-        # row.split()[0]! is to avoid the last row of string
-        if indicator and row.split()[0]!='STARTTIMEOFFSET':
-            
-            splited_row = row.split()
-
-            #voltage array
-            voltage_array.append(float(splited_row[2]))
-
-            #time array(for the purpose of calculating capacity)
-            time_delta_s = float(splited_row[1])
-            t_array.append(time_delta_s)
-            total_time_array.append(starting_date_time + datetime.timedelta(seconds=time_delta_s))
-
-            #pH arrays
-            pH_array_left.append((float(splited_row[11])*pH_left_calibration['slope'])+pH_left_calibration['intercept'])       
-            pH_array_right.append((float(splited_row[17])*pH_right_calibration['slope'])+pH_right_calibration['intercept'])       
-
-            #current array
-            current_array.append(float(splited_row[3]))
-
-            #temperature array
-            temperature_array.append(float(splited_row[8]))
-            
-    #remove unnecessary glitches on the pH data through fitting
-    pH_fit_left = np.polyfit(t_array,pH_array_left,6)
-    total_pH_fit_left = np.poly1d(pH_fit_left)
-    fitted_pH_array_left = total_pH_fit_left(t_array)
-
-    pH_fit_right = np.polyfit(t_array,pH_array_right,6)
-    total_pH_fit_right = np.poly1d(pH_fit_right)
-    fitted_pH_array_right = total_pH_fit_right(t_array)
-
-    #Assign cycle number and type of echem_process to the dataframe
-    cycle_number_array = len(total_time_array)*[cycle_number]
-    echem_process_array = len(total_time_array)*[echem_process]
+    cycle_number,echem_process = _gamry_file_labels(file.name)
+
+    #locate the data block once and convert the whole table into typed columns in one call
+    nrows = _find_data_block(file)
+    columns = _read_data_block(file,nrows)
+    _calibrate_pH_columns(columns,pH_right_calibration,pH_left_calibration)
+
+    #remove unnecessary glitches on the pH data
+    _smooth_pH_columns(columns,smoothing)
 
     #calculate capacity of this half cycle
-    capacity_array = np.cumsum(current_array)
+    columns['Capacity'] = np.cumsum(columns['Current'])
 
-    dataset = pd.DataFrame({'Delta_T_s':t_array,'Cycle_number':cycle_number_array,'Echem_process':echem_process_array,'Time':total_time_array,'Voltage':voltage_array,
-                        'Current':current_array,'Capacity':capacity_array,'pH_left':pH_array_left,'pH_right':pH_array_right
-                        ,'fitted_pH_left':fitted_pH_array_left,'fitted_pH_right':fitted_pH_array_right,'Temperature':temperature_array})
-    
+    dataset = _gamry_frame(columns,starting_date_time,cycle_number,echem_process)
     
     return dataset
 
 
-def read_echem(path,cycle_number=5,co2=True,pH_right_calibration={'slope':-17.4,'intercept':7.728},pH_left_calibration={'slope':-17.602,'intercept':7.1728}):
+def iter_gamry_file(path,starting_date_time,chunk_rows=100000,pH_right_calibration={'slope':-17.4,'intercept':7.728},pH_left_calibration={'slope':-17.602,'intercept':7.1728},fit_pH=True,smoothing='polynomial'):
+    '''
+    Streaming counterpart of **analyze_gamry_file** for very long half-cycles (e.g. month-long voltage holds in
+    `Invasion_#N.DTA` and `Outgas_#N.DTA`). The data block is read from a memory-mapped file in chunks of **chunk_rows**
+    rows and each chunk is yielded as a dataset with the same attributes as **analyze_gamry_file**, so peak memory
+    depends on **chunk_rows** and not on the length of the file.
+
+    Calibration, pH smoothing and capacity are the same as in **analyze_gamry_file**; capacity is carried over between
+    chunks. The polynomial pH fit needs the whole file, so with smoothing='polynomial' the file is read twice: the
+    first pass accumulates the least-squares fit with an incremental QR factorization and the second pass yields the
+    chunks with the fitted values, which agree with **smooth_pH** to numerical precision. The rolling methods
+    ('savgol', 'median' and 'hampel') read the file once and hold back the last rows of each chunk until the rows within
+    their reach (half a window, a whole window for 'hampel') have been read, so the fitted values equal those of the
+    whole file.
+
+    .. note::   Here is an example
+
+                .. code-block:: python
+
+                    capacity = 0
+                    for chunk in iter_gamry_file(path+'OTHER/Outgas_#1.DTA',starting_date_time,chunk_rows=50000):
+                        capacity = chunk['Capacity'].iloc[-1]
+
+    :type path: string
+    :param path: the address of the Gamry file
+
+    :type starting_date_time: datetime.datetime
+    :param starting_date_time: the initial datetime of the process
+
+    :type chunk_rows: int
+    :param chunk_rows: maximum number of rows in each yielded dataset
+
+    :type pH_right_calibration: dict
+    :param pH_right_calibration: dictionary that contains the slope of intercept information of the right pH probe calibration
+
+    :type pH_left_calibration: dict
+    :param pH_left_calibration: dictionary that contains the slope of intercept information of the left pH probe calibration
+
+    :type fit_pH: boolean
+    :param fit_pH: If False, the same as smoothing=None
+
+    :type smoothing: string
+    :param smoothing: method used by **smooth_pH** for the fitted pH, with the options of **PH_SMOOTHING_DEFAULTS**. If None, ['fitted_pH_left'] and ['fitted_pH_right'] are NaN and the file is read only once.
+
+    :rtype: *generator*
+    :return: datasets of at most **chunk_rows** rows with the attributes described in **analyze_gamry_file**
+    '''
+    if smoothing is not None and smoothing not in PH_SMOOTHING_DEFAULTS:
+        raise ValueError('Unknown pH smoothing method {}, use one of {}'.format(smoothing,list(PH_SMOOTHING_DEFAULTS)))
+    if not fit_pH:
+        smoothing = None
+    cycle_number,echem_process = _gamry_file_labels(path)
+    with open(path,'r') as file:
+        nrows = _find_data_block(file)
+        offset = file.tell()
+
+    degree = PH_SMOOTHING_DEFAULTS['polynomial']['degree']
+    if smoothing == 'polynomial' and nrows > degree:
+        coefficients,t_scale = _stream_pH_fit(path,offset,nrows,chunk_rows,pH_right_calibration,pH_left_calibration,degree)
+
+    chunks = _iter_calibrated_block(path,offset,nrows,chunk_rows,pH_right_calibration,pH_left_calibration)
+    if smoothing in ['savgol','median','hampel']:
+        chunks = _iter_rolling_smoothed(chunks,nrows,chunk_rows,smoothing)
+
+    capacity_offset = 0
+    for columns in chunks:
+        if smoothing == 'polynomial' and nrows > degree:
+            fitted = np.vander(columns['Delta_T_s']/t_scale,degree+1)@coefficients
+            columns['fitted_pH_left'] = fitted[:,0]
+            columns['fitted_pH_right'] = fitted[:,1]
+        elif smoothing in ['polynomial','none']:
+            #too short to fit, or no smoothing: the pH data as is
+            columns['fitted_pH_left'] = columns['pH_left'].copy()
+            columns['fitted_pH_right'] = columns['pH_right'].copy()
+        elif smoothing is None:
+            columns['fitted_pH_left'] = np.full(len(columns['Delta_T_s']),np.nan)
+            columns['fitted_pH_right'] = np.full(len(columns['Delta_T_s']),np.nan)
+        columns['Capacity'] = capacity_offset+np.cumsum(columns['Current'])
+        capacity_offset = columns['Capacity'][-1]
+        yield _gamry_frame(columns,starting_date_time,cycle_number,echem_process)
+
+def _iter_calibrated_block(path,offset,nrows,chunk_rows,pH_right_calibration,pH_left_calibration):
+    '''
+    Yields the chunks of **_iter_data_block** with calibrated pH.
+    '''
+    for columns in _iter_data_block(path,offset,nrows,chunk_rows):
+        _calibrate_pH_columns(columns,pH_right_calibration,pH_left_calibration)
+        yield columns
+
+def _iter_rolling_smoothed(chunks,nrows,chunk_rows,method):
+    '''
+    Adds the fitted pH of a rolling **method** of **smooth_pH** ('savgol', 'median' or 'hampel') to the calibrated chunks
+    of a Gamry file of **nrows** rows. A row is smoothed once the rows within the reach of the method after it have been
+    read, together with twice that reach of rows before it, so its value is the one of smoothing the whole file. Yields
+    chunks of at most **chunk_rows** rows.
+    '''
+    options = dict(PH_SMOOTHING_DEFAULTS[method])
+    if method == 'savgol':
+        #smooth_pH shortens the window for files shorter than it
+        options['window'] = min(options['window'],nrows if nrows%2 else nrows-1)
+    #the Hampel filter takes the median of deviations from medians, which reaches a whole window
+    reach = 2*(options['window']//2) if method == 'hampel' else options['window']//2
+    before = None #rows already yielded, kept as context
+    pending = None #rows read but not yielded
+    for columns in chunks:
+        pending = columns if pending is None else {name:np.concatenate((pending[name],columns[name])) for name in pending}
+        ready = len(pending['Delta_T_s'])-reach
+        #a savgol window needs 2*reach+1 rows, which the context provides once the first rows are yielded
+        if ready > 0 and (before is not None or len(pending['Delta_T_s']) > 2*reach):
+            before,pending,smoothed = _smooth_ready_rows(before,pending,ready,2*reach,method,options)
+            yield from _split_columns(smoothed,chunk_rows)
+    if pending is not None and len(pending['Delta_T_s']):
+        before,pending,smoothed = _smooth_ready_rows(before,pending,len(pending['Delta_T_s']),2*reach,method,options)
+        yield from _split_columns(smoothed,chunk_rows)
+
+def _smooth_ready_rows(before,pending,ready,context_rows,method,options):
+    '''
+    Smooths the first **ready** rows of **pending** with the rows of **before** and **pending** around them. Returns the
+    new context (the last **context_rows** rows up to the smoothed ones), the remaining pending rows and the smoothed rows.
+    '''
+    window = pending if before is None else {name:np.concatenate((before[name],pending[name])) for name in pending}
+    start = len(window['Delta_T_s'])-len(pending['Delta_T_s'])
+    smoothed = {name:values[:ready] for name,values in pending.items()}
+    for side in ['left','right']:
+        smoothed['fitted_pH_'+side] = smooth_pH(window['Delta_T_s'],window['pH_'+side],method,**options)[start:start+ready]
+    end = start+ready
+    before = {name:values[max(end-context_rows,0):end] for name,values in window.items()}
+    pending = {name:values[ready:] for name,values in pending.items()}
+    return before,pending,smoothed
+
+def _split_columns(columns,chunk_rows):
+    '''
+    Yields **columns** in pieces of at most **chunk_rows** rows.
+    '''
+    for start in range(0,len(columns['Delta_T_s']),chunk_rows):
+        yield {name:values[start:start+chunk_rows] for name,values in columns.items()}
+
+def _iter_data_block(path,offset,nrows,chunk_rows):
+    '''
+    Yields the data block of a Gamry file that starts at byte **offset** as dictionaries of NumPy columns of at most
+    **chunk_rows** rows, reading through a read-only memory map.
+    '''
+    with open(path,'rb') as file:
+        with mmap.mmap(file.fileno(),0,access=mmap.ACCESS_READ) as mapped:
+            mapped.seek(offset)
+            reader = pd.read_csv(mapped,sep='\t',header=None,nrows=nrows,usecols=list(GAMRY_DATA_COLUMNS.values()),
+                                 dtype=np.float64,engine='c',chunksize=chunk_rows)
+            with reader:
+                for block in reader:
+                    yield {name:block[column].to_numpy() for name,column in GAMRY_DATA_COLUMNS.items()}
+
+def _stream_pH_fit(path,offset,nrows,chunk_rows,pH_right_calibration,pH_left_calibration,degree=6):
+    '''
+    Fits a polynomial of **degree** to both pH channels of a Gamry file in one bounded-memory pass. Each chunk is folded
+    into a running (degree+1)x(degree+1) R factor with a QR factorization, so the result matches a least-squares fit on
+    the whole file.
+    Time is scaled by the time span estimated from the first chunk to keep the Vandermonde columns well conditioned.
+
+    :rtype: *tuple*
+    :return: (coefficients,t_scale): a (degree+1)x2 array of polynomial coefficients (highest power first) in t/**t_scale** for the left and right pH channels, and the time scale
+    '''
+    r_factor = np.zeros((0,degree+1))
+    rhs = np.zeros((0,2))
+    t_scale = None
+    for columns in _iter_calibrated_block(path,offset,nrows,chunk_rows,pH_right_calibration,pH_left_calibration):
+        if t_scale is None:
+            t_scale = max(np.max(np.abs(columns['Delta_T_s']))*nrows/len(columns['Delta_T_s']),1.0)
+        q_factor,r_factor = np.linalg.qr(np.vstack((r_factor,np.vander(columns['Delta_T_s']/t_scale,degree+1))))
+        rhs = q_factor.T@np.vstack((rhs,np.column_stack((columns['pH_left'],columns['pH_right']))))
+    return np.linalg.lstsq(r_factor,rhs,rcond=None)[0],t_scale
+
+
+#Categories of ['Echem_process'], in recorded order. Sharing them lets half-cycle datasets concatenate as a categorical
+ECHEM_PROCESSES = ['PWRCHARGE','Invasion','PWRDISCHARGE','Outgas']
+
+#Measured columns stored as float32 by read_echem(float32=True)
+ECHEM_FLOAT_COLUMNS = ['Voltage','Current','Capacity','pH_left','pH_right','fitted_pH_left','fitted_pH_right','Temperature','Delta_T_s']
+
+#Column order of the dataset returned by read_echem
+ECHEM_COLUMNS = ['Time','Cycle_number','Echem_process','Voltage','Current','Capacity','pH_left','pH_right',
+                 'fitted_pH_left','fitted_pH_right','Temperature','Delta_T_s']
+
+def _echem_file_at(path,position,co2=True):
+    '''
+    Returns the Gamry file recorded at **position** (0 for PWRCHARGE_#1) in the order of **_echem_file_sequence**.
+    '''
+    per_cycle = 4 if co2 else 2
+    return _echem_file_sequence(path,position//per_cycle+1,co2)[position]
+
+def _echem_file_sequence(path,cycle_number,co2=True):
+    '''
+    Returns the Gamry files of an electrochemistry folder in the order they were recorded: charge, invasion,
+    discharge and outgas of cycle 1, then of cycle 2, etc. Invasion and outgas files are left out if **co2** is False.
+    '''
+    files = []
+    for i in range(1,cycle_number+1):
+        files.append(path+'CHARGE_DISCHARGE/PWRCHARGE_#'+str(i)+'.DTA')
+        if co2:
+            files.append(path+'OTHER/Invasion_#'+str(i)+'.DTA')
+        files.append(path+'CHARGE_DISCHARGE/PWRDISCHARGE_#'+str(i)+'.DTA')
+        if co2:
+            files.append(path+'OTHER/Outgas_#'+str(i)+'.DTA')
+    return files
+
+def _analyze_gamry_path(file_path,starting_date_time,pH_right_calibration={'slope':-17.4,'intercept':7.728},pH_left_calibration={'slope':-17.602,'intercept':7.1728},cache_dir=None,smoothing='polynomial'):
+    '''
+    Opens **file_path** and runs **analyze_gamry_file** on it. Module-level so that it can be sent to worker processes.
+    If **cache_dir** is given, the parsed columns are loaded from or stored in the cache described in **read_echem**.
+    '''
+    if cache_dir is not None:
+        cache_file = _echem_cache_file(cache_dir,file_path,pH_right_calibration,pH_left_calibration,smoothing)
+        if os.path.exists(cache_file):
+            return _load_echem_cache(cache_file,starting_date_time)
+    with open(file_path,'r') as file:
+        dataset = analyze_gamry_file(file,starting_date_time,pH_right_calibration=pH_right_calibration,pH_left_calibration=pH_left_calibration,
+                                     smoothing=smoothing)
+    if cache_dir is not None:
+        _store_echem_cache(cache_dir,cache_file,file_path,dataset)
+    return dataset
+
+#Version of the cached column layout. Bump it when analyze_gamry_file changes what it computes.
+ECHEM_CACHE_VERSION = 2
+
+#Size in bytes above which the least recently used cache entries are evicted
+ECHEM_CACHE_MAX_BYTES = 2*1024**3
+
+#Columns of analyze_gamry_file that do not depend on the starting datetime and are stored in the cache
+ECHEM_CACHE_COLUMNS = ['Delta_T_s','Voltage','Current','Capacity','pH_left','pH_right','fitted_pH_left','fitted_pH_right','Temperature']
+
+def _echem_cache_file(cache_dir,file_path,pH_right_calibration,pH_left_calibration,smoothing='polynomial'):
+    '''
+    Returns the cache entry of a Gamry file. The name starts with **_echem_cache_state**, so that all entries of one
+    file, and those of its current version, can be found, followed by a hash of the calibration parameters and the pH
+    smoothing method. Entries of the same file with other settings are kept side by side.
+    '''
+    settings = json.dumps([pH_right_calibration,pH_left_calibration,smoothing],sort_keys=True)
+    return os.path.join(cache_dir,_echem_cache_state(file_path)+hashlib.sha1(settings.encode()).hexdigest()[:16]+'.npz')
+
+def _echem_cache_state(file_path):
+    '''
+    Returns the file name prefix shared by the cache entries of the current version of a Gamry file: **_echem_cache_prefix**
+    followed by a hash of **ECHEM_CACHE_VERSION** and the file size and modification time.
+    '''
+    stat = os.stat(file_path)
+    fingerprint = json.dumps([ECHEM_CACHE_VERSION,stat.st_size,stat.st_mtime_ns])
+    return _echem_cache_prefix(file_path)+hashlib.sha1(fingerprint.encode()).hexdigest()[:16]+'_'
+
+def _echem_cache_prefix(file_path):
+    '''
+    Returns the file name prefix shared by all cache entries of a Gamry file.
+    '''
+    return hashlib.sha1(os.path.abspath(file_path).encode()).hexdigest()[:16]+'_'
+
+def _load_echem_cache(cache_file,starting_date_time):
+    '''
+    Rebuilds an **analyze_gamry_file** dataset from a cache entry and marks the entry as recently used.
+    '''
+    with np.load(cache_file) as cached:
+        matrix = cached['columns']
+        columns = {name:matrix[:,k] for k,name in enumerate(ECHEM_CACHE_COLUMNS)}
+        cycle_number = int(cached['Cycle_number'])
+        echem_process = str(cached['Echem_process'])
+    os.utime(cache_file)
+    return _gamry_frame(columns,starting_date_time,cycle_number,echem_process)
+
+def _store_echem_cache(cache_dir,cache_file,file_path,dataset):
+    '''
+    Writes the columns of **dataset** to **cache_file**. The entry is written to a temporary file first so that
+    concurrent workers never read a partial entry. Stale entries are removed afterwards by **_prune_echem_cache**.
+    '''
+    os.makedirs(cache_dir,exist_ok=True)
+    temporary_file = cache_file+'.'+str(os.getpid())+'.tmp'
+    with open(temporary_file,'wb') as file:
+        np.savez(file,Cycle_number=dataset['Cycle_number'].iloc[0],Echem_process=dataset['Echem_process'].iloc[0],
+                 columns=dataset[ECHEM_CACHE_COLUMNS].to_numpy(dtype=np.float64))
+    os.replace(temporary_file,cache_file)
+
+def _prune_echem_cache(cache_dir,file_paths):
+    '''
+    Removes the cache entries of **file_paths** left by older versions of the files (or of the cache layout), keeping
+    the entries of their current version with any calibration and smoothing, then evicts least recently used entries
+    above **ECHEM_CACHE_MAX_BYTES**. Called once per read, after all files are parsed.
+    '''
+    if not os.path.isdir(cache_dir):
+        return
+    states = {_echem_cache_prefix(file_path):_echem_cache_state(file_path) for file_path in file_paths}
+    for entry in glob.glob(os.path.join(cache_dir,'*.npz')):
+        name = os.path.basename(entry)
+        state = states.get(name[:name.find('_')+1])
+        if state is not None and not name.startswith(state):
+            try:
+                os.remove(entry)
+            except FileNotFoundError:
+                pass
+    clear_echem_cache(cache_dir,max_bytes=ECHEM_CACHE_MAX_BYTES)
+
+def clear_echem_cache(cache_dir,path=None,max_bytes=None):
+    '''
+    Invalidates entries of the parsed Gamry file cache used by **read_echem**, **cal_capacity_energy** and
+    **create_echem_dfs** when they are called with **cache_dir**.
+
+    .. note::   Entries are also invalidated automatically when a Gamry file's size or modification time changes.
+
+    :type cache_dir: string
+    :param cache_dir: the cache folder
+
+    :type path: string
+    :param path: a Gamry file or a folder of Gamry files. If given, only the entries of these files are removed.
+
+    :type max_bytes: int
+    :param max_bytes: if given, only the least recently used entries are removed until the cache is smaller than **max_bytes**
+
+    :rtype: *int*
+    :return: number of removed entries
+    '''
+    if not os.path.isdir(cache_dir):
+        return 0
+    entries = glob.glob(os.path.join(cache_dir,'*.npz'))
+    if path is not None:
+        if os.path.isdir(path):
+            prefixes = tuple(_echem_cache_prefix(file_path) for file_path in glob.glob(os.path.join(path,'**','*.DTA'),recursive=True))
+        else:
+            prefixes = (_echem_cache_prefix(path),)
+        entries = [entry for entry in entries if os.path.basename(entry).startswith(prefixes)]
+    if max_bytes is not None:
+        entries.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(entry) for entry in entries)
+        evicted = []
+        for entry in entries:
+            if total <= max_bytes:
+                break
+            total -= os.path.getsize(entry)
+            evicted.append(entry)
+        entries = evicted
+    for entry in entries:
+        try:
+            os.remove(entry)
+        except FileNotFoundError:
+            #removed by another worker
+            pass
+    return len(entries)
+
+def _chain_starting_times(frames,starting_date_time):
+    '''
+    Rewrites ['Time'] of consecutive half-cycle datasets in place so that the first one starts at **starting_date_time**
+    and every following one starts at the last Time of the previous one, as if they had been parsed in order.
+    '''
+    for df in frames:
+        df['Time'] = pd.Timestamp(starting_date_time)+pd.to_timedelta(df['Delta_T_s'],unit='s')
+        starting_date_time = df['Time'].iloc[-1]
+
+def read_gamry_header(file_path):
+    '''
+    Reads only the header of a Gamry file, up to the CURVE TABLE line, and returns its start datetime and the location
+    and size of its data block.
+
+    :type file_path: string
+    :param file_path: the address of the Gamry file
+
+    :rtype: *dict*
+    :return: a dictionary with the following keys\n
+            dict['File'] -> str: **file_path**\n
+            dict['Cycle_number'] -> int: cycle number encoded in the file name\n
+            dict['Echem_process'] -> str: PWRCHARGE, Invasion, PWRDISCHARGE or Outgas\n
+            dict['Start_Time'] -> datetime.datetime: the datetime that the Gamry file was created\n
+            dict['Data_Offset'] -> int: byte offset of the first data row\n
+            dict['Row_Count'] -> int: number of rows in the data block\n
+    '''
+    cycle_number,echem_process = _gamry_file_labels(file_path)
+    with open(file_path,'r') as file:
+        start_time = find_date_time(file)
+        row_count = _find_data_block(file)
+        data_offset = file.tell()
+    return {'File':file_path,'Cycle_number':cycle_number,'Echem_process':echem_process,'Start_Time':start_time,
+            'Data_Offset':data_offset,'Row_Count':row_count}
+
+def create_header_index(path,cycle_number=None,co2=True):
+    '''
+    Builds a header index of a Gamry folder with **read_gamry_header**, one row per file in the order the files were
+    recorded. The index can be passed to **read_echem**, **cal_capacity_energy** and **find_echem_time_period** so
+    that headers are read only once.
+
+    :type path: string
+    :param path: the address of the folder that contains the electrochemistry files.
+
+    :type cycle_number: int
+    :param cycle_number: number of full electrochemical cycles. If None, the number of PWRCHARGE files in the folder is used.
+
+    :type co2: boolean
+    :param co2: whether CO2 capture/release took place, i.e. whether Invasion and Outgas files are indexed
+
+    :rtype: *pd.DataFrame*
+    :return: a dataset with the attributes ['File'], ['Cycle_number'], ['Echem_process'], ['Start_Time'], ['Data_Offset'] and ['Row_Count'] described in **read_gamry_header**
+    '''
+    if cycle_number is None:
+        cycle_number = len(glob.glob(path+'CHARGE_DISCHARGE/PWRCHARGE_#*.DTA'))
+    return pd.DataFrame([read_gamry_header(file_path) for file_path in _echem_file_sequence(path,cycle_number,co2)],
+                        columns=['File','Cycle_number','Echem_process','Start_Time','Data_Offset','Row_Count'])
+
+def read_echem(path,cycle_number=5,co2=True,pH_right_calibration={'slope':-17.4,'intercept':7.728},pH_left_calibration={'slope':-17.602,'intercept':7.1728},n_jobs=1,header_index=None,cache_dir=None,float32=False,smoothing='polynomial'):
     '''    
     Reads a Gamry file folder, utilizes **analyze_gamry_file** to get half-cycle data and puts everything together
     in a dataset with multi-cycle continuous Time,Voltage, Current,pH and fitted pH data.
@@ -186,13 +727,28 @@ def read_echem(path,cycle_number=5,co2=True,pH_right_calibration={'slope':-17.4,
     :type pH_left_calibration: dict
     :param pH_left_calibration: dictionary that contains the slope of intercept information of the left pH probe calibration
 
+    :type n_jobs: int
+    :param n_jobs: number of worker processes. If larger than 1, all charge, invasion, discharge and outgas files are parsed at once on a process pool and the absolute Time of each file is chained afterwards from the previous file's last ['Delta_T_s'].
+
+    :type header_index: pd.DataFrame
+    :param header_index: header index created by **create_header_index**. If given, the starting time is taken from it instead of reading the first header again.
+
+    :type cache_dir: string
+    :param cache_dir: opt-in cache folder. The calibrated columns of each parsed file are stored there as .npz, keyed by the file path, size, modification time, the pH calibrations and **smoothing**, and are loaded instead of re-parsing the file on later calls. Entries of older versions of the files are dropped and least recently used entries are evicted above **ECHEM_CACHE_MAX_BYTES** once per call; use **clear_echem_cache** to invalidate entries.
+
+    :type float32: boolean
+    :param float32: if True, the measured columns (**ECHEM_FLOAT_COLUMNS**) are stored as float32 to halve their memory. ['Time'] and ['Time_Delta'] keep full precision.
+
+    :type smoothing: string
+    :param smoothing: pH smoothing method of **smooth_pH** used for the fitted pH. If None, the fitted pH columns are left empty (NaN); use **smooth_echem_pH** to compute them later.
+
     :rtype: *pd.DataFrame*
     :return: **dataset**: a dataset with multi-cycle continuous Time,Voltage, Current,pH and fitted pH data.
 
             dataset -> pandas.DataFrame: a dataset contains the following attributes\n
-            dataset['Time'] -> datetime.datetime: datetime of the current datum point\n
-            dataset['Cycle_number'] -> int: current cycle number\n
-            dataset['Echem_process'] -> str: PWRCHARGE refers to charge and PWRDISCHARGE refers to discharge\n
+            dataset['Time'] -> datetime64[ns]: datetime of the current datum point\n
+            dataset['Cycle_number'] -> int16: current cycle number\n
+            dataset['Echem_process'] -> category: PWRCHARGE refers to charge and PWRDISCHARGE refers to discharge, categories are **ECHEM_PROCESSES**\n
             dataset['Voltage'] -> float: voltage data\n
             dataset['Current'] -> float: current data\n
             dataset['Capacity'] -> float: capacity in Coulomb\n
@@ -201,69 +757,109 @@ def read_echem(path,cycle_number=5,co2=True,pH_right_calibration={'slope':-17.4,
             dataset['fitted_pH'] -> float: fitted pH data. Fluctuations were removed.\n
     '''
     
-    #Import deacidification/acidification data
-    srcdir = path+'CHARGE_DISCHARGE/'
-    echem_files = glob.glob(srcdir+'*.DTA')
-
-    #Import voltage-hold period (invasion and outgas) data
-    voltage_hold_srcdir = path +'OTHER/'
-    voltage_hold_files =glob.glob(voltage_hold_srcdir+'*.DTA')
-    
-    dataset = pd.DataFrame(columns = ['Time','Cycle_number','Echem_process','Voltage','Current','Capacity','pH_left','pH_right'
-                                      ,'fitted_pH_left','fitted_pH_right','Temperature'])
+    frames = _read_echem_frames(path,cycle_number,co2,pH_right_calibration,pH_left_calibration,n_jobs,header_index,cache_dir,smoothing)
+    return _assemble_echem_dataset(frames,float32)
 
+def _read_echem_frames(path,cycle_number,co2,pH_right_calibration,pH_left_calibration,n_jobs,header_index,cache_dir=None,smoothing='polynomial'):
+    '''
+    Parses every Gamry file of a folder once with **analyze_gamry_file** and returns the half-cycle datasets in recorded
+    order, with continuous Time. Arguments are the same as in **read_echem**.
+    '''
     ###initialize the starting time using the first charging file###
-    with open(srcdir+'PWRCHARGE_#1.DTA','r') as initial_file:
-        starting_date_time = find_date_time(initial_file)
-        
-    ###import electrochemistry data###
-    
-    # The value of i is the same as cycle_number -1
-    # The idea here is: 
-    # 1.Locate a particular cycle number i+1
-    # 2.Append i+1 cycle's Charge Data
-    # 3.Append i+1 cycle's CO2 infusing data
-    # 4.Append i+1 cycle's Discharge Data
-    # 5.Append i+1 cycle's CO2 outgasing data
-    for i in tqdm(range(cycle_number)):
-        
-        ##Deacidification (Charge)
-        with open(srcdir+'PWRCHARGE_#'+str(i+1)+'.DTA','r') as file:
-            if i == 0:
-                df = analyze_gamry_file(file,starting_date_time,pH_right_calibration=pH_right_calibration,pH_left_calibration=pH_left_calibration)
-            else:
-                df = analyze_gamry_file(file,dataset.iloc[-1]['Time'],pH_right_calibration=pH_right_calibration,pH_left_calibration=pH_left_calibration)
-        
-        
-        dataset = dataset.append(df,ignore_index = True)
+    if header_index is None:
+        with open(path+'CHARGE_DISCHARGE/PWRCHARGE_#1.DTA','r') as initial_file:
+            starting_date_time = find_date_time(initial_file)
+    else:
+        starting_date_time = header_index['Start_Time'].iloc[0]
 
-        if co2:
-            #invasion data
-            with open(voltage_hold_srcdir+'Invasion_#'+str(i+1)+'.DTA','r') as file:
-                df = analyze_gamry_file(file,dataset.iloc[-1]['Time'],pH_right_calibration=pH_right_calibration,pH_left_calibration=pH_left_calibration)
+    ###import electrochemistry data###
 
-            dataset = dataset.append(df,ignore_index = True)
-        
-        ##Discharge data
-        with open(srcdir+'PWRDISCHARGE_#'+str(i+1)+'.DTA','r') as file:
-            df = analyze_gamry_file(file,dataset.iloc[-1]['Time'],pH_right_calibration=pH_right_calibration,pH_left_calibration=pH_left_calibration)
-        
-        dataset = dataset.append(df,ignore_index = True)
-        
-        
-        ##Outgass data
-        if co2:
-            with open(voltage_hold_srcdir+'Outgas_#'+str(i+1)+'.DTA','r') as file:
-                df = analyze_gamry_file(file,dataset.iloc[-1]['Time'],pH_right_calibration=pH_right_calibration,pH_left_calibration=pH_left_calibration)
-                #df['pH'] = df['pH'] - 0.1 
+    # Files are read cycle by cycle in the order charge, CO2 infusing (invasion), discharge and CO2 outgasing.
+    # Each half cycle starts at the last Time of the previous one.
+    files = _echem_file_sequence(path,cycle_number,co2)
+    if n_jobs > 1:
+        #each file only depends on the previous one through its starting time, which is the previous file's
+        #last Time. Parse every file on its own and stitch the absolute time afterwards.
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            frames = list(tqdm(executor.map(_analyze_gamry_path,files,[starting_date_time]*len(files),
+                                            [pH_right_calibration]*len(files),[pH_left_calibration]*len(files),
+                                            [cache_dir]*len(files),[smoothing]*len(files)),total=len(files)))
+        _chain_starting_times(frames,starting_date_time)
+    else:
+        frames = []
+        for file_path in tqdm(files):
+            df = _analyze_gamry_path(file_path,starting_date_time,pH_right_calibration,pH_left_calibration,cache_dir,smoothing)
+            starting_date_time = df['Time'].iloc[-1]
+            frames.append(df)
+    if cache_dir is not None:
+        _prune_echem_cache(cache_dir,files)
 
-            dataset = dataset.append(df,ignore_index = True)
-            
-        dataset['Time_Delta'] = (dataset['Time']-dataset.iloc[0]['Time']).apply(lambda x: x.days*24+x.seconds/3600)
+    return frames
 
+def _assemble_echem_dataset(frames,float32=False):
+    '''
+    Concatenates half-cycle datasets from **analyze_gamry_file** once, in the column order of **read_echem**, and adds
+    ['Time_Delta'], the time in hours since the first datum point. With **float32**, the measured columns are downcast.
+    '''
+    #files of other processes than ECHEM_PROCESSES add their own category, which all frames need to concatenate as a categorical
+    categories = list(dict.fromkeys(category for df in frames for category in df['Echem_process'].cat.categories))
+    if len(categories) > len(ECHEM_PROCESSES):
+        for df in frames:
+            df['Echem_process'] = df['Echem_process'].cat.set_categories(categories)
+    dataset = pd.concat(frames,ignore_index=True)[ECHEM_COLUMNS]
+    if float32:
+        dataset = dataset.astype({name:np.float32 for name in ECHEM_FLOAT_COLUMNS})
+    dataset['Time_Delta'] = (dataset['Time']-dataset['Time'].iloc[0]).dt.total_seconds()/3600
     return dataset
 
-def cal_capacity_energy(path,cycle_number = 5):
+def cumulative_charge(current,time=None,initial_time=None):
+    '''
+    Integrates **current** against **time** once and returns the charge passed before each row, so that the charge
+    between any two rows a and b is the O(1) difference charge[b]-charge[a]. Each sample is weighted by the time interval
+    that ends at it, which is the same as summing the rows for 1 s sampling. NaN current (e.g. gas-only rows of
+    **total_df**) counts as no current, and rows without a time have no interval: the interval of the next sample starts
+    at the last sample with a time.
+
+    .. note::   Here is an example
+
+                .. code-block:: python
+
+                    charge = cumulative_charge(total_df['Current'],total_df['Time'])
+                    delta_TA = (charge[index_b]-charge[index_a])/96485/volume
+
+    :type current: np.ndarray or pd.Series
+    :param current: current in A, or any other rate to integrate, e.g. power in W
+
+    :type time: np.ndarray or pd.Series
+    :param time: time of each sample, in seconds or as datetime, e.g. the echem time ['Time'] of **total_df**. The gas-log ['Datetime'] repeats a second when two echem samples fall in it, which gives the second one no interval. If None, samples are 1 s apart.
+
+    :type initial_time: float or datetime.datetime
+    :param initial_time: start of the interval of the first sample, e.g. 0 for ['Delta_T_s'] of a Gamry file. If None, the first interval is as long as the second one.
+
+    :rtype: *np.ndarray*
+    :return: array of length len(**current**)+1, charge in Coulomb passed before each row. The last element is the total charge.
+    '''
+    current = np.nan_to_num(np.asarray(current,dtype=np.float64))
+    if time is None:
+        intervals = np.ones(len(current))
+    else:
+        time = np.asarray(time)
+        if time.dtype.kind == 'M' or time.dtype == object:
+            time = pd.to_datetime(time).to_numpy(dtype='datetime64[ns]')
+            origin = time[~np.isnat(time)][0] if (~np.isnat(time)).any() else np.datetime64(0,'ns')
+            if initial_time is not None:
+                initial_time = (np.datetime64(pd.Timestamp(initial_time),'ns')-origin)/np.timedelta64(1,'s')
+            time = (time-origin)/np.timedelta64(1,'s')
+        time = np.asarray(time,dtype=np.float64)
+        valid = ~np.isnan(time)
+        sample_time = time[valid]
+        if initial_time is None:
+            initial_time = 2*sample_time[0]-sample_time[1] if len(sample_time) > 1 else (sample_time[0]-1 if len(sample_time) else 0.0)
+        intervals = np.zeros(len(time))
+        intervals[valid] = np.diff(sample_time,prepend=initial_time)
+    return np.concatenate(([0.0],np.cumsum(current*intervals)))
+
+def cal_capacity_energy(path,cycle_number = 5,header_index=None,cache_dir=None):
     """    
     Reads a Gamry file folder, utilizes **analyze_gamry_file** to get half-cycle data and 
     puts everything together in a dataset with multi-cycle's cycle capacity,energy and efficiencies.
@@ -307,6 +903,12 @@ def cal_capacity_energy(path,cycle_number = 5):
     :type cycle_number: int
     :param cycle_number: number of full electrochemical cycles performed.
 
+    :type header_index: pd.DataFrame
+    :param header_index: header index created by **create_header_index**. If None, the index is built from **path**.
+
+    :type cache_dir: string
+    :param cache_dir: opt-in cache folder for parsed Gamry files, see **read_echem**
+
     :rtype: *pd.DataFrame*
     :return: **dataset** a dataset that containts multi-cycle's cycle capacity,energy and efficiencies.
 
@@ -320,14 +922,25 @@ def cal_capacity_energy(path,cycle_number = 5):
     """
     
     
-    #Import deacidification/acidification data
-    srcdir = path+'CHARGE_DISCHARGE/'
-    echem_files = glob.glob(srcdir+'*.DTA')
-
-    #Import voltage-hold period (invasion and outgas) data
-    voltage_hold_srcdir = path +'OTHER/'
-    voltage_hold_files =glob.glob(voltage_hold_srcdir+'*.DTA')
+    if header_index is None:
+        header_index = create_header_index(path,cycle_number=cycle_number,co2=False)
+    files = header_index.set_index(['Echem_process','Cycle_number'])['File']
     
+    ###initialize the starting time using the first charging file###
+    starting_date_time = header_index['Start_Time'].iloc[0]
+
+    charge_frames = [_analyze_gamry_path(files['PWRCHARGE',i+1],starting_date_time,cache_dir=cache_dir) for i in range(cycle_number)]
+    discharge_frames = [_analyze_gamry_path(files['PWRDISCHARGE',i+1],starting_date_time,cache_dir=cache_dir) for i in range(cycle_number)]
+    if cache_dir is not None:
+        _prune_echem_cache(cache_dir,[files['PWRCHARGE',i+1] for i in range(cycle_number)]+[files['PWRDISCHARGE',i+1] for i in range(cycle_number)])
+
+    return _capacity_energy_dataset(charge_frames,discharge_frames)
+
+def _capacity_energy_dataset(charge_frames,discharge_frames):
+    '''
+    Computes the dataset returned by **cal_capacity_energy** from the charge and discharge datasets of each cycle,
+    given in cycle order.
+    '''
     cycle_array = []
     charge_cap_array = []
     charge_energy_array = []
@@ -337,26 +950,14 @@ def cal_capacity_energy(path,cycle_number = 5):
     energy_efficiency_array = []
     #dataset = pd.DataFrame([0,0,0,0,0,0],columns = ['Cycle','Charge Capacity','Charge Energy',
     #                                   'Discharge Capacity','Discharge Energy','Coulombic Efficiency'])
-    
-    ###initialize the starting time using the first charging file###
-    with open(srcdir+'PWRCHARGE_#1.DTA','r') as initial_file:
-        starting_date_time = find_date_time(initial_file)
-        
-    for i in range(cycle_number):
-        with open(srcdir+'PWRCHARGE_#'+str(i+1)+'.DTA','r') as file:
-            
-            charge_df = analyze_gamry_file(file,starting_date_time)
-
-        
-        with open(srcdir+'PWRDISCHARGE_#'+str(i+1)+'.DTA','r') as file:
-            
-            discharge_df = analyze_gamry_file(file,starting_date_time)
         
+    for i,(charge_df,discharge_df) in enumerate(zip(charge_frames,discharge_frames)):
         cycle_array.append(i+1)
-        charge_cap_array.append(np.sum(charge_df['Current']))
-        charge_energy_array.append(np.sum(charge_df['Current']*charge_df['Voltage']))
-        discharge_cap_array.append(np.sum(discharge_df['Current']))
-        discharge_energy_array.append(np.sum(discharge_df['Current']*discharge_df['Voltage']))
+        #integrate current and power over the sampling intervals of the potentiostat, starting from 0 s
+        charge_cap_array.append(cumulative_charge(charge_df['Current'],charge_df['Delta_T_s'],initial_time=0)[-1])
+        charge_energy_array.append(cumulative_charge(charge_df['Current']*charge_df['Voltage'],charge_df['Delta_T_s'],initial_time=0)[-1])
+        discharge_cap_array.append(cumulative_charge(discharge_df['Current'],discharge_df['Delta_T_s'],initial_time=0)[-1])
+        discharge_energy_array.append(cumulative_charge(discharge_df['Current']*discharge_df['Voltage'],discharge_df['Delta_T_s'],initial_time=0)[-1])
         coulombic_efficiency_array.append(abs(discharge_cap_array[-1]/charge_cap_array[-1]))
         energy_efficiency_array.append(abs(discharge_energy_array[-1]/charge_energy_array[-1]))
     dataset = pd.DataFrame({'Cycle_Number':cycle_array,'Charge_Capacity':charge_cap_array,
@@ -368,10 +969,10 @@ def cal_capacity_energy(path,cycle_number = 5):
     return dataset
         
 
-def find_echem_time_period(path,co2=True,cycle_number=5,outgas_time = 165):
+def find_echem_time_period(path,co2=True,cycle_number=5,outgas_time = 165,header_index=None):
     
     """ 
-      Utilizes `find_date_time method`, reads a Gamry folder and returns a dataset containing the start and end time 
+      Utilizes the header index from `create_header_index`, reads a Gamry folder and returns a dataset containing the start and end time 
       of deacidification, capture, acidification and outgas.
     
         .. warning:: 
@@ -414,6 +1015,9 @@ def find_echem_time_period(path,co2=True,cycle_number=5,outgas_time = 165):
       :type outgas_time: float
       :param outgas_time: time in minutes for the outgas period
 
+      :type header_index: pd.DataFrame
+      :param header_index: header index created by **create_header_index**. If None, the index is built from **path**.
+
       :rtype: *pd.DataFrame*
       :return:     a dataset that contains the start and end time of deacidification, capture, acidification and outgas.
             dataset -> pandas.DataFrame: a dataset that contains the following attributes\n
@@ -426,71 +1030,24 @@ def find_echem_time_period(path,co2=True,cycle_number=5,outgas_time = 165):
     """
     
     
-    #Import electrochemistry data 
-    srcdir = path + 'CHARGE_DISCHARGE/'
-    files = glob.glob(srcdir + '*.DTA')
-    #Import voltage hold data    
-    voltage_hold_srcdir = path + 'OTHER/'
-    voltage_hold_files = glob.glob(voltage_hold_srcdir + '*.DTA')
-    #initialize the column needed
-    cycle_array = []
-    charge_start_time_array = []
-    capture_start_time_array = []
-    discharge_start_time_array = []
-    outgas_start_time_array = []
-    outgas_end_time_array = []
-    
-    for i in range(1,cycle_number+1):
-        cycle_array.append(i)
-        with open(srcdir+'PWRCHARGE_#'+str(i)+'.DTA',newline='') as charge_file:
-            charge_start_time_array.append(find_date_time(charge_file))
-        if co2:
-            with open(voltage_hold_srcdir+'Invasion_#'+str(i)+'.DTA',newline = '') as capture_file:
-                capture_start_time_array.append(find_date_time(capture_file))
-        with open(srcdir+'PWRDISCHARGE_#'+str(i)+'.DTA',newline='') as discharge_file:
-            discharge_start_time_array.append(find_date_time(discharge_file))
-            if not co2:
-                for row in discharge_file:
-                    if row.startswith('DATE'):
-                        year = int(row.split()[2].split('/')[2])
-                        month = int(row.split()[2].split('/')[0])
-                        day = int(row.split()[2].split('/')[1])
-                    if row.startswith('TIME'):
-                        hour = int(row.split()[2].split(':')[0])
-                        minute = int(row.split()[2].split(':')[1])
-                        second = int(row.split()[2].split(':')[2])
-        if co2:
-            with open(voltage_hold_srcdir+'Outgas_#'+str(i)+'.DTA',newline = '') as outgas_file:
-                for row in outgas_file:
-                    if row.startswith('DATE'):
-                        year = int(row.split()[2].split('/')[2])
-                        month = int(row.split()[2].split('/')[0])
-                        day = int(row.split()[2].split('/')[1])
-                    if row.startswith('TIME'):
-                        hour = int(row.split()[2].split(':')[0])
-                        minute = int(row.split()[2].split(':')[1])
-                        second = int(row.split()[2].split(':')[2])
-            
-            outgas_start_time = datetime.datetime(year,month,day,hour,minute,second)
-            outgas_start_time_array.append(outgas_start_time)
-            minute = minute+int(outgas_time%60)
-            hour = hour+int(outgas_time//60)
-            if minute >= 60:
-                minute = minute - 60
-                hour = hour + 1
-            if hour >= 24:
-                hour = hour-24
-                day = day+1
-            if day > 30 and month in [4,6,9,11]:
-                day = 1
-                month = month+1
-            if day > 31 and month in [1,3,5,7,8,10,12]:
-                day = 1
-                month = month+1
-            #not accounted for February!!!
-                
-            outgas_end_time = datetime.datetime(year,month,day,hour,minute,second)
-            outgas_end_time_array.append(outgas_end_time)
+    if header_index is None:
+        header_index = create_header_index(path,cycle_number=cycle_number,co2=co2)
+    return _time_period_dataset(header_index,cycle_number,co2,outgas_time)
+
+def _time_period_dataset(header_index,cycle_number,co2,outgas_time):
+    '''
+    Computes the dataset returned by **find_echem_time_period** from a header index created by **create_header_index**.
+    '''
+    start_times = header_index.set_index(['Echem_process','Cycle_number'])['Start_Time']
+
+    cycle_array = list(range(1,cycle_number+1))
+    charge_start_time_array = [start_times['PWRCHARGE',i] for i in cycle_array]
+    discharge_start_time_array = [start_times['PWRDISCHARGE',i] for i in cycle_array]
+    if co2:
+        capture_start_time_array = [start_times['Invasion',i] for i in cycle_array]
+        outgas_start_time_array = [start_times['Outgas',i] for i in cycle_array]
+        outgas_end_time_array = [start_time+datetime.timedelta(minutes=outgas_time) for start_time in outgas_start_time_array]
+
     if co2:
         dataset = pd.DataFrame({'Cycle':cycle_array,'Charge_Start_Time':charge_start_time_array,
                             'Capture_Start_Time':capture_start_time_array,
@@ -502,11 +1059,12 @@ def find_echem_time_period(path,co2=True,cycle_number=5,outgas_time = 165):
                             'Discharge_Start_Time':discharge_start_time_array})
     return dataset
 
-def create_echem_dfs(path,co2=False,cycle_number=5,outgas_time=165,pH_right_calibration={'slope':-17.4,'intercept':7.728},pH_left_calibration={'slope':-17.602,'intercept':7.1728}):
+def create_echem_dfs(path,co2=False,cycle_number=5,outgas_time=165,pH_right_calibration={'slope':-17.4,'intercept':7.728},pH_left_calibration={'slope':-17.602,'intercept':7.1728},n_jobs=1,cache_dir=None,float32=False,smoothing='polynomial'):
     
     """    
       Combine the results of **read_echem**, **cal_capacity_energy**, 
       and **find_echem_time_period** to produce a dictionary of the three dfs.
+      Each Gamry file is parsed once and each header is read once; the three dfs are derived from the same data.
 
         .. warning:: 
             The folder structure must be like the following:
@@ -558,6 +1116,18 @@ def create_echem_dfs(path,co2=False,cycle_number=5,outgas_time=165,pH_right_cali
       :type pH_left_calibration: dict
       :param pH_left_calibration: dictionary that contains the slope of intercept information of the left pH probe calibration
 
+      :type n_jobs: int
+      :param n_jobs: number of worker processes used to parse the Gamry files, see **read_echem**
+
+      :type cache_dir: string
+      :param cache_dir: opt-in cache folder for parsed Gamry files, see **read_echem**
+
+      :type float32: boolean
+      :param float32: store the measured columns of echem_df as float32, see **read_echem**
+
+      :type smoothing: string
+      :param smoothing: pH smoothing method of echem_df, see **read_echem**
+
       :rtype: *dict*
       :return: a dictionary of echem_df,energy_df and time_df
     
@@ -568,23 +1138,243 @@ def create_echem_dfs(path,co2=False,cycle_number=5,outgas_time=165,pH_right_cali
     #Process Echem Data
     electrochem_path = path
 
+    #read every header once
+    header_index = create_header_index(electrochem_path,cycle_number=cycle_number,co2=co2)
+
+    #parse every file once
+    frames = _read_echem_frames(electrochem_path,cycle_number,co2,pH_right_calibration,pH_left_calibration,n_jobs,header_index,cache_dir,smoothing)
+
     #create echem df
-    echem_df = read_echem(electrochem_path,co2=co2,cycle_number =cycle_number,pH_right_calibration=pH_right_calibration,pH_left_calibration=pH_left_calibration)
+    echem_df = _assemble_echem_dataset(frames,float32)
 
     #concatenate all df and create a total echem df
     echem_df['Hours']=echem_df.index/3600
 
-    #create energy df
-    energy_df = cal_capacity_energy(electrochem_path,cycle_number=cycle_number)
+    #create energy df from the charge and discharge files already parsed
+    energy_df = _capacity_energy_dataset([df for df in frames if df['Echem_process'].iloc[0]=='PWRCHARGE'],
+                                         [df for df in frames if df['Echem_process'].iloc[0]=='PWRDISCHARGE'])
 
     #create time df
-    #107/120 because the voltage hold period is 107 minute, determined by deducting echem time from 2 hour.
-    time_df = find_echem_time_period(electrochem_path,cycle_number=cycle_number,outgas_time=outgas_time,co2=co2)
+    time_df = _time_period_dataset(header_index,cycle_number,co2,outgas_time)
     #display(time_40_df)
     
     return {"echem_df":echem_df,"energy_df":energy_df,"time_df":time_df}
 
 
+def _gamry_header_complete(file_path):
+    '''
+    Returns True once the header of a Gamry file that is being written is complete, i.e. once the CURVE TABLE line and
+    the column name and unit rows that follow it all end with a newline.
+    '''
+    with open(file_path,'rb') as file:
+        for row in iter(file.readline,b''):
+            if not row.endswith(b'\n'):
+                return False
+            if row.startswith(b'CURVE'):
+                return all(file.readline().endswith(b'\n') for _ in range(2))
+    return False
+
+class LiveEchemReader:
+    '''
+    Incremental reader for an electrochemistry folder that is still being written by the potentiostat. The folder
+    structure is the same as in **read_echem**. Each call of **poll** parses only the files created and the rows appended
+    since the previous call, remembering the byte offset reached in the file that is being recorded, and appends them to
+    the columns of the run, which grow in place. Refreshing costs time proportional to the new data and not to the
+    length of the run.
+
+    A file is considered complete once the next file of the sequence (charge, invasion, discharge, outgas, next charge,
+    ...) exists. Only complete rows (ending with a newline) are parsed, and a file is skipped until its header is
+    complete. The pH of a file is fitted once, when it is complete, so ['fitted_pH_left'] and ['fitted_pH_right'] are
+    NaN for the file that is being recorded. Call **finish** when the experiment has ended to fit the last file.
+
+    .. note::   Here is an example
+
+                .. code-block:: python
+
+                    reader = LiveEchemReader(electrochem_path,co2=True)
+                    new_rows = reader.poll()
+                    #...later
+                    new_rows = reader.poll()
+                    echem_df = reader.dataset
+                    #...once the experiment has ended
+                    echem_df = reader.finish()
+
+    :type path: string
+    :param path: the address of the folder that contains the electrochemistry files.
+
+    :type co2: boolean
+    :param co2: whether CO2 capture/release takes place, i.e. whether Invasion and Outgas files are expected
+
+    :type pH_right_calibration: dict
+    :param pH_right_calibration: dictionary that contains the slope of intercept information of the right pH probe calibration
+
+    :type pH_left_calibration: dict
+    :param pH_left_calibration: dictionary that contains the slope of intercept information of the left pH probe calibration
+
+    :type smoothing: string
+    :param smoothing: pH smoothing method, see **read_echem**
+    '''
+
+    #types of the columns of the run
+    _COLUMN_TYPES = {'Time':'datetime64[ns]','Cycle_number':np.int16,'Echem_process':np.int8,
+                     **{name:np.float64 for name in ECHEM_FLOAT_COLUMNS},'Time_Delta':np.float64}
+
+    def __init__(self,path,co2=True,pH_right_calibration={'slope':-17.4,'intercept':7.728},pH_left_calibration={'slope':-17.602,'intercept':7.1728},smoothing='polynomial'):
+        self.path = path
+        self.co2 = co2
+        self.pH_right_calibration = pH_right_calibration
+        self.pH_left_calibration = pH_left_calibration
+        self.smoothing = smoothing
+        #columns of the run, with spare capacity at the end. Only the first _length rows are used.
+        self._buffers = {name:np.empty(0,dtype=dtype) for name,dtype in self._COLUMN_TYPES.items()}
+        self._length = 0
+        self._dataset = None
+        self._position = 0
+        self._starting_date_time = None
+        self._first_time = None
+        self._reset_active_file()
+
+    def _reset_active_file(self):
+        self._offset = None
+        self._block_ended = False
+        #first row of the file being recorded in the columns of the run
+        self._file_start = self._length
+
+    @property
+    def dataset(self):
+        '''
+        The dataset read so far, with the attributes of **read_echem**, including the rows of the file being recorded.
+        It is a view of the columns of the reader, built without copying them; use `.copy()` to keep a snapshot.
+        '''
+        if self._dataset is None:
+            columns = {name:self._buffers[name][:self._length] for name in ECHEM_COLUMNS+['Time_Delta']}
+            columns['Echem_process'] = pd.Categorical.from_codes(columns['Echem_process'],dtype=pd.CategoricalDtype(ECHEM_PROCESSES),
+                                                                 validate=False)
+            self._dataset = pd.DataFrame(columns,copy=False)
+        return self._dataset
+
+    def poll(self):
+        '''
+        Parses the files and rows written since the last call.
+
+        :rtype: *pd.DataFrame*
+        :return: the rows added since the last call, with the attributes of **read_echem**. ['Time_Delta'] is relative to the first datum point of the run. ['fitted_pH_left'] and ['fitted_pH_right'] are NaN, the fits are added to **dataset** once each file is complete.
+        '''
+        first_new_row = self._length
+        while True:
+            file_path = _echem_file_at(self.path,self._position,self.co2)
+            if not os.path.exists(file_path):
+                break
+            if self._offset is None:
+                if not _gamry_header_complete(file_path):
+                    break
+                try:
+                    header = read_gamry_header(file_path)
+                except ValueError:
+                    #the header is malformed, try again at the next poll
+                    break
+                self._offset = header['Data_Offset']
+                if self._starting_date_time is None:
+                    self._starting_date_time = header['Start_Time']
+
+            self._read_new_rows(file_path)
+            if not os.path.exists(_echem_file_at(self.path,self._position+1,self.co2)):
+                break
+
+            #the next file exists, so this one is complete
+            self._fit_active_file()
+            if self._length > self._file_start:
+                self._starting_date_time = pd.Timestamp(self._buffers['Time'][self._length-1])
+            self._position += 1
+            self._reset_active_file()
+
+        rows = {name:self._buffers[name][first_new_row:self._length].copy() for name in ECHEM_COLUMNS+['Time_Delta']}
+        rows['Echem_process'] = pd.Categorical.from_codes(rows['Echem_process'],categories=ECHEM_PROCESSES)
+        return pd.DataFrame(rows)
+
+    def finish(self):
+        '''
+        Reads the remaining rows and fits the pH of the file being recorded, which has no next file to mark it complete.
+        Call it once the experiment has ended.
+
+        :rtype: *pd.DataFrame*
+        :return: **dataset**
+        '''
+        self.poll()
+        self._fit_active_file()
+        return self.dataset
+
+    def _fit_active_file(self):
+        '''
+        Fills the fitted pH of the file being recorded with **smooth_pH** over its rows.
+        '''
+        if self.smoothing is None or self._length == self._file_start:
+            return
+        rows = slice(self._file_start,self._length)
+        for side in ['left','right']:
+            self._buffers['fitted_pH_'+side][rows] = smooth_pH(self._buffers['Delta_T_s'][rows],self._buffers['pH_'+side][rows],self.smoothing)
+        self._dataset = None
+
+    def _append(self,columns):
+        '''
+        Copies **columns** after the last row of the run, doubling the capacity of the columns when they are full.
+        '''
+        new_row_count = len(columns['Time'])
+        end = self._length+new_row_count
+        if end > len(self._buffers['Time']):
+            capacity = max(end,2*len(self._buffers['Time']),1024)
+            for name,buffer in self._buffers.items():
+                self._buffers[name] = np.empty(capacity,dtype=buffer.dtype)
+                self._buffers[name][:self._length] = buffer[:self._length]
+        for name,values in columns.items():
+            self._buffers[name][self._length:end] = values
+        self._length = end
+        self._dataset = None
+
+    def _read_new_rows(self,file_path):
+        '''
+        Parses the complete data rows appended to the file being recorded since the last poll and appends them to the
+        columns of the run.
+
+        :rtype: *int*
+        :return: number of new rows
+        '''
+        if self._block_ended:
+            return 0
+        with open(file_path,'rb') as file:
+            file.seek(self._offset)
+            chunk = file.read()
+        #keep complete rows only
+        chunk = chunk[:chunk.rfind(b'\n')+1]
+        self._offset += len(chunk)
+        #data rows start with a tab, the first row that does not ends the data block
+        trailer = re.search(rb'(?m)^[^\t]',chunk)
+        if trailer is not None:
+            chunk = chunk[:trailer.start()]
+            self._block_ended = True
+        if not chunk:
+            return 0
+
+        columns = _read_data_block(io.BytesIO(chunk),None)
+        new_row_count = len(columns['Delta_T_s'])
+        _calibrate_pH_columns(columns,self.pH_right_calibration,self.pH_left_calibration)
+        #the capacity of each half cycle starts at 0 and continues from the last row read
+        previous_capacity = self._buffers['Capacity'][self._length-1] if self._length > self._file_start else 0.0
+        columns['Capacity'] = np.cumsum(np.concatenate(([previous_capacity],columns['Current'])))[1:]
+        columns['fitted_pH_left'] = columns['fitted_pH_right'] = np.full(new_row_count,np.nan)
+        cycle_number,echem_process = _gamry_file_labels(file_path)
+        columns['Cycle_number'] = np.full(new_row_count,cycle_number,dtype=np.int16)
+        #files of the sequence are always one of ECHEM_PROCESSES
+        columns['Echem_process'] = np.full(new_row_count,ECHEM_PROCESSES.index(echem_process),dtype=np.int8)
+        time = pd.Timestamp(self._starting_date_time)+pd.to_timedelta(columns['Delta_T_s'],unit='s')
+        columns['Time'] = time.to_numpy(dtype='datetime64[ns]')
+        if self._first_time is None:
+            self._first_time = time[0]
+        columns['Time_Delta'] = (time-self._first_time).total_seconds().to_numpy()/3600
+        self._append(columns)
+        return new_row_count
+
+
 def read_gamry_eis(path):
     """
     read Gamry EIS file and output a dataframe containing frequency, Zreal and Zimag
@@ -7,13 +7,177 @@ import csv
 import sys
 import glob
 import pickle
+import os
+import json
+import hashlib
 from scipy.signal import lfilter,savgol_filter
+import timeline
+
+#Types of the columns of the LabVIEW gas log, other than 'date' and 'time'
+GAS_LOG_SCHEMA = {'loop_num':np.int32,
+                  'N2 input left(abs val)':np.float64,'N2 input right(abs val)':np.float64,
+                  'CO2 input left(abs val)':np.float64,'CO2 input right(abs val)':np.float64,
+                  'flow sensor left(sccm)':np.float64,'flow sensor right(sccm)':np.float64,
+                  'CO2 sensor left(abs val)':np.float64,'CO2 sensor right(abs val)':np.float64}
+
+#Columns of the gas log used by this package, read by default
+GAS_LOG_COLUMNS = ['loop_num','N2 input right(abs val)','CO2 input right(abs val)','flow sensor right(sccm)','CO2 sensor right(abs val)']
+
+GAS_LOG_DATETIME_FORMAT = '%m/%d/%Y %H:%M:%S'
+
+#Increase when the layout of the gas log cache changes, so that older entries are ignored
+GAS_LOG_CACHE_VERSION = 2
+
+#Size in bytes above which the least recently used gas log cache entries are evicted
+GAS_LOG_CACHE_MAX_BYTES = 2*1024**3
+
+def read_gas_log(file,columns=None,chunksize=1000000,float32=False,cache_dir=None):
+    """
+            Reads a LabVIEW gas log into a dataset for `find_gas_change_time()` and `utils.merge_echem_gas_df()`, in place
+            of `pd.read_csv()` followed by building ['Datetime'] from ['date'] and ['time']. Only **columns** are read,
+            with the types of **GAS_LOG_SCHEMA**, and the datetime is parsed with the fixed **GAS_LOG_DATETIME_FORMAT**
+            instead of being inferred. The file is read **chunksize** rows at a time, so the text columns of the whole
+            log are never in memory at once.
+
+        .. note::   Here is an example
+
+                    .. code-block:: python
+
+                        gas_df = read_gas_log("CO2Flow/20210211_Full_cell_right_CO2_3hr_switch_cycling.txt",cache_dir='gas_cache')
+                        change_gas_df = find_gas_change_time(gas_df,gas_switch_period=10800)
+                        total_df = utils.merge_echem_gas_df(echem_df,gas_df)
+
+        :type file: string
+        :param file: path of the gas log, a comma separated file with a header row
+
+        :type columns: list
+        :param columns: columns to read besides 'date' and 'time'. If None, **GAS_LOG_COLUMNS**. Columns that are not in **GAS_LOG_SCHEMA** are read as float.
+
+        :type chunksize: int
+        :param chunksize: Number of rows parsed at a time
+
+        :type float32: boolean
+        :param float32: If True, the float columns are stored as float32, which halves their memory.
+
+        :type cache_dir: string
+        :param cache_dir: opt-in cache folder. The parsed columns are stored there as .npz, keyed by the file path, size, modification time, **columns** and **float32**, and are loaded instead of parsing the log again on later calls. Entries of older versions of the log are dropped and least recently used entries are evicted above **GAS_LOG_CACHE_MAX_BYTES**.
+
+        :rtype: *pd.DataFrame*
+        :return: dataset with **columns** and ['Datetime'], the date and time of each row. The ['date'] and ['time'] text columns are not kept.
+    """
+    columns = list(GAS_LOG_COLUMNS if columns is None else columns)
+    float_type = np.float32 if float32 else np.float64
+    dtypes = {name:(float_type if GAS_LOG_SCHEMA.get(name,np.float64) == np.float64 else GAS_LOG_SCHEMA[name]) for name in columns}
+
+    if cache_dir is not None:
+        cache_file = _gas_log_cache_file(cache_dir,file,columns,float32)
+        dataset = _load_gas_log_cache(cache_file,columns)
+        if dataset is not None:
+            return dataset
+
+    frames = []
+    for chunk in pd.read_csv(file,header=0,usecols=['date','time']+columns,dtype={'date':str,'time':str,**dtypes},
+                             chunksize=chunksize):
+        frame = chunk[columns].reset_index(drop=True)
+        frame['Datetime'] = _parse_gas_log_datetime(chunk['date'],chunk['time'])
+        frames.append(frame)
+    dataset = pd.concat(frames,ignore_index=True) if frames else pd.DataFrame({**{name:pd.Series(dtype=dtype) for name,dtype in dtypes.items()},
+                                                                               'Datetime':pd.Series(dtype='datetime64[ns]')})
+
+    if cache_dir is not None:
+        _store_gas_log_cache(cache_dir,cache_file,file,dataset,columns)
+    return dataset
+
+def _parse_gas_log_datetime(date,time):
+    '''
+    Parses the ['date'] and ['time'] text columns of a gas log into datetime64[ns]. A log spans only a few days, so each
+    distinct date is parsed once. Times in the fixed 'HH:MM:SS' layout are converted from their characters directly;
+    otherwise the whole column falls back to `pd.to_datetime()` with **GAS_LOG_DATETIME_FORMAT**.
+    '''
+    time = np.char.strip(time.to_numpy(dtype='U'))
+    digits = time.astype('S8').view(np.uint8).reshape(-1,8).astype(np.int64)-ord('0')
+    if (np.char.str_len(time) != 8).any() or (digits[:,[2,5]] != ord(':')-ord('0')).any() or \
+       ((digits[:,[0,1,3,4,6,7]] < 0) | (digits[:,[0,1,3,4,6,7]] > 9)).any():
+        return pd.to_datetime(date.str.strip()+' '+pd.Series(time,index=date.index),format=GAS_LOG_DATETIME_FORMAT).to_numpy(dtype='datetime64[ns]')
+    date = date.str.strip().astype('category')
+    days = pd.to_datetime(date.cat.categories,format=GAS_LOG_DATETIME_FORMAT.split(' ')[0]).to_numpy(dtype='datetime64[ns]')[date.cat.codes.to_numpy()]
+    seconds = (digits[:,0]*10+digits[:,1])*3600+(digits[:,3]*10+digits[:,4])*60+digits[:,6]*10+digits[:,7]
+    return days+seconds.astype('timedelta64[s]')
+
+def _gas_log_cache_file(cache_dir,file,columns,float32):
+    '''
+    Returns the cache entry of a gas log. The name starts with **_gas_log_cache_state**, followed by a hash of the read
+    options, so that entries of the same log read with other options are kept side by side.
+    '''
+    options = json.dumps([columns,float32])
+    return os.path.join(cache_dir,_gas_log_cache_state(file)+hashlib.sha1(options.encode()).hexdigest()[:16]+'.npz')
+
+def _gas_log_cache_state(file):
+    '''
+    Returns the file name prefix shared by the cache entries of the current version of a gas log: a hash of its
+    absolute path followed by a hash of **GAS_LOG_CACHE_VERSION** and its size and modification time.
+    '''
+    file = os.path.abspath(file)
+    stat = os.stat(file)
+    fingerprint = json.dumps([GAS_LOG_CACHE_VERSION,stat.st_size,stat.st_mtime_ns])
+    return hashlib.sha1(file.encode()).hexdigest()[:16]+'_'+hashlib.sha1(fingerprint.encode()).hexdigest()[:16]+'_'
+
+def _load_gas_log_cache(cache_file,columns):
+    '''
+    Rebuilds a **read_gas_log** dataset from a cache entry and marks the entry as recently used. Returns None if there
+    is no entry, including when another process removes it while it is being opened.
+    '''
+    try:
+        with np.load(cache_file) as cached:
+            dataset = pd.DataFrame({name:cached['column_{}'.format(k)] for k,name in enumerate(columns)})
+            dataset['Datetime'] = cached['Datetime']
+        os.utime(cache_file)
+    except FileNotFoundError:
+        return None
+    return dataset
+
+def _store_gas_log_cache(cache_dir,cache_file,file,dataset,columns):
+    '''
+    Writes the columns of **dataset** to **cache_file**, then drops the entries of older versions of the same gas log
+    and evicts least recently used entries above **GAS_LOG_CACHE_MAX_BYTES**. The entry is written to a temporary file
+    first so that concurrent readers never load a partial entry.
+    '''
+    os.makedirs(cache_dir,exist_ok=True)
+    temporary_file = cache_file+'.'+str(os.getpid())+'.tmp'
+    with open(temporary_file,'wb') as f:
+        np.savez(f,Datetime=dataset['Datetime'].to_numpy(),
+                 **{'column_{}'.format(k):dataset[name].to_numpy() for k,name in enumerate(columns)})
+    os.replace(temporary_file,cache_file)
+
+    state = _gas_log_cache_state(file)
+    path_prefix = state.split('_')[0]+'_'
+    entries = []
+    for entry in glob.glob(os.path.join(cache_dir,'*.npz')):
+        name = os.path.basename(entry)
+        try:
+            if name.startswith(path_prefix) and not name.startswith(state):
+                os.remove(entry)
+            else:
+                entries.append((os.path.getmtime(entry),os.path.getsize(entry),entry))
+        except FileNotFoundError:
+            #removed by another process
+            pass
+    total = sum(size for _,size,_ in entries)
+    for _,size,entry in sorted(entries):
+        if total <= GAS_LOG_CACHE_MAX_BYTES:
+            break
+        total -= size
+        try:
+            os.remove(entry)
+        except FileNotFoundError:
+            pass
 
 def find_gas_change_time(gas_df,gas_switch_period = 7200,time_attribute='Datetime'):
     """    
             Reads a dataset that has a **time_attribute**. This dataset, usually created by `pd.read_csv()` or 
             `utils.merge_echem_gas_df()`, should contain CO2 concentration change info. 
-            Returns a dataset that contains the time that each gas switch is made.
+            Returns a dataset that contains the time that each gas switch is made, assuming a switch every
+            **gas_switch_period** rows. Use `detect_gas_change_time()` when rows are missing or the schedule changes.
 
         :type gas_df: pd.DataFrame
         :param gas_df: the dataframe that contains gas data, i.e. pCO2, flowrate, MFC input, etc.
@@ -30,7 +194,7 @@ def find_gas_change_time(gas_df,gas_switch_period = 7200,time_attribute='Datetim
 
               time_df['Cycle'] -> (*int*): number of cycles\n
               time_df['low_to_high'] -> (*datetime.datetime*): The date and time that pCO2 is changed from low value to high value, e.g. from 0.1 bar to 1 bar\n
-              time_df['high_to_low'] -> (*datetime.datetime*): The date and time that pCO2 is changed from high value to low value, e.g. from 1 bar to 0.1 bar\n
+              time_df['high_to_low'] -> (*datetime.datetime*): The date and time that pCO2 is changed from high value to low value, e.g. from 1 bar to 0.1 bar. NaT if the last cycle is incomplete.\n
 
     """
     i = 1
@@ -51,7 +215,7 @@ def find_gas_change_time(gas_df,gas_switch_period = 7200,time_attribute='Datetim
             high_to_low_array.append(gas_df.iloc[i*gas_switch_period][time_attribute])
             i+= 1
     if len(high_to_low_array)<len(low_to_high_array):
-        high_to_low_array.append('')
+        high_to_low_array.append(pd.NaT)
     time_df = pd.DataFrame({"Cycle":cycle_array,"low_to_high":
                             low_to_high_array,"high_to_low":high_to_low_array})
     
@@ -59,7 +223,86 @@ def find_gas_change_time(gas_df,gas_switch_period = 7200,time_attribute='Datetim
             
 
 
-def create_baseline(gas_df,start,end,parameter = 'CO2_Flow',baseline_range = 100,reverse_outgas_baseline_range=False):
+def detect_gas_change_time(gas_df,parameter=None,time_attribute='Datetime',threshold=None,hysteresis=0.1):
+    """
+            Finds the gas switches from the signal itself instead of a fixed period, so it works for runs with missing
+            rows or changing schedules. By default the signal is the pCO2 set by the mass flow controllers,
+            gas_df['CO2 input right(abs val)']/(gas_df['CO2 input right(abs val)']+gas_df['N2 input right(abs val)']).
+            A measured signal, e.g. 'right_pco2' or 'CO2 sensor right(abs val)', can be used instead, in which case the
+            switch is found when the sensor crosses the threshold, after the delay of the gas line and the sensor.
+
+            The signal is classified as high above **threshold** + band and low below **threshold** - band, keeping the
+            previous class in between, so that noise around the threshold does not create switches. Switches are the
+            rows where the class changes, found in one vectorized pass.
+
+        .. note::   Here is an example
+
+                    .. code-block:: python
+
+                        change_gas_df = detect_gas_change_time(gas_df)
+                        measured_change_gas_df = detect_gas_change_time(total_df,parameter='right_pco2')
+
+        :type gas_df: pd.DataFrame
+        :param gas_df: the dataframe that contains gas data, i.e. pCO2, flowrate, MFC input, etc.
+
+        :type parameter: string
+        :param parameter: **gas_df**'s attribute used as the signal. If None, the set-point pCO2 of the right channel is used.
+
+        :type time_attribute: string
+        :param time_attribute: **gas_df**'s attribute that contains datetime information, usually 'Datetime' or 'Time'.
+
+        :type threshold: float
+        :param threshold: Level separating low and high pCO2. If None, the middle between the 1st and 99th percentiles of the signal.
+
+        :type hysteresis: float
+        :param hysteresis: Half width of the band around **threshold**, as a fraction of the signal range (99th minus 1st percentile).
+
+        :rtype: *pd.DataFrame*
+        :return:
+              **time_df**: a dataframe with the columns of `find_gas_change_time()` and the row positions of the switches. Switches from high to low before the first switch from low to high are ignored.
+
+              time_df['Cycle'] -> (*int*): number of cycles\n
+              time_df['low_to_high'] -> (*datetime.datetime*): The date and time that pCO2 is changed from low value to high value, e.g. from 0.1 bar to 1 bar\n
+              time_df['high_to_low'] -> (*datetime.datetime*): The date and time that pCO2 is changed from high value to low value, e.g. from 1 bar to 0.1 bar. NaT if the last cycle is incomplete.\n
+              time_df['low_to_high_index'] -> (*int*): row position in **gas_df** of the first row after the low to high switch\n
+              time_df['high_to_low_index'] -> (*int*): row position in **gas_df** of the first row after the high to low switch, <NA> if the last cycle is incomplete.\n
+
+    """
+    if parameter is None:
+        co2 = gas_df['CO2 input right(abs val)'].to_numpy(dtype=np.float64)
+        signal = co2/(co2+gas_df['N2 input right(abs val)'].to_numpy(dtype=np.float64))
+    else:
+        signal = gas_df[parameter].to_numpy(dtype=np.float64)
+
+    low,high = np.nanpercentile(signal,[1,99]) if len(signal) else (np.nan,np.nan)
+    if threshold is None:
+        threshold = (low+high)/2
+    band = hysteresis*(high-low)
+    #1 for high, 0 for low, NaN inside the band or for missing values, which keep the previous class
+    state = np.full(len(signal),np.nan)
+    state[signal>threshold+band] = 1
+    state[signal<threshold-band] = 0
+    state = pd.Series(state).ffill().to_numpy()
+    change = np.diff(state)
+    low_to_high_index = np.flatnonzero(change==1)+1
+    high_to_low_index = np.flatnonzero(change==-1)+1
+    if len(low_to_high_index):
+        high_to_low_index = high_to_low_index[high_to_low_index>low_to_high_index[0]]
+    else:
+        high_to_low_index = high_to_low_index[:0]
+
+    times = gas_df[time_attribute]
+    cycle_number = len(low_to_high_index)
+    high_to_low_array = pd.Series(pd.NaT,index=range(cycle_number),dtype=times.dtype)
+    high_to_low_array.iloc[:len(high_to_low_index)] = times.iloc[high_to_low_index].to_numpy()
+    high_to_low_position = pd.Series(pd.NA,index=range(cycle_number),dtype='Int64')
+    high_to_low_position.iloc[:len(high_to_low_index)] = high_to_low_index
+
+    return pd.DataFrame({"Cycle":np.arange(1,cycle_number+1),"low_to_high":times.iloc[low_to_high_index].to_numpy(),
+                         "high_to_low":high_to_low_array,"low_to_high_index":low_to_high_index,
+                         "high_to_low_index":high_to_low_position})
+
+def create_baseline(gas_df,start,end,parameter = 'CO2_Flow',baseline_range = 100,reverse_outgas_baseline_range=False,timeline_index=None):
     ''' 
     
     Reads a dataset created by `pd.read_csv()` on gas data or created by `utils.merge_echem_gas_df()`, 
@@ -87,24 +330,28 @@ def create_baseline(gas_df,start,end,parameter = 'CO2_Flow',baseline_range = 100
     :type reverse_outgas_baseline_range: boolean
     :param reverse_capture_baseline_range: Input True when you want to use **outgas_period** to calculate the outgased amount. 
 
+    :type timeline_index: timeline.TimelineIndex
+    :param timeline_index: index over gas_df['Datetime'] used to locate **start** and **end**. If None, one is built. Pass one built once when calling this function repeatedly.
+
 
     :rtype: *tuple*
     :return:
-          **(fit, a1,a2)** : A tuple containing fit, created by `np.polyfit(x,y,1)`, and parameter a1 and a2 of y=a1x+a2, on indices 0,1,2 respectively.
+          **(fit, index_1,index_2)** : A tuple containing fit, created by `np.polyfit(x,y,1)`, and the row positions of **start** and **end**, on indices 0,1,2 respectively.
 
     '''
-    point1 = gas_df[gas_df['Datetime']==start]
-    point2 = gas_df[gas_df['Datetime']==end]
-    index_1 = point1.index.values[0]
-    index_2 = point2.index.values[0]
+    if timeline_index is None:
+        timeline_index = timeline.TimelineIndex(gas_df)
+    index_1 = timeline_index.locate(start)
+    index_2 = timeline_index.locate(end)
 
     x1 = gas_df.iloc[index_1-baseline_range:index_1]['Time_Delta'].values
+    y1 = gas_df.iloc[index_1-baseline_range:index_1][parameter].values
     if not reverse_outgas_baseline_range:
         x2 = gas_df.iloc[index_2-baseline_range:index_2]['Time_Delta'].values
+        y2 = gas_df.iloc[index_2-baseline_range:index_2][parameter].values
     else:
         x2 = gas_df.iloc[index_2:index_2+baseline_range]['Time_Delta'].values
-    y1 = gas_df.iloc[index_1-baseline_range:index_1][parameter].values
-    y2 = gas_df.iloc[index_2-baseline_range:index_2][parameter].values
+        y2 = gas_df.iloc[index_2:index_2+baseline_range][parameter].values
     #solve a1x+a2 = y
         
     x = np.hstack((x1,x2))
@@ -115,8 +362,165 @@ def create_baseline(gas_df,start,end,parameter = 'CO2_Flow',baseline_range = 100
     return fit,index_1,index_2
 
 
+def fit_baselines(gas_df,starts,ends,parameter = 'CO2_Flow',baseline_range = 100,reverse_outgas_baseline_range=False,timeline_index=None):
+    '''
+    Batched version of `create_baseline()`: fits the linear baselines of many processes at once. Cumulative sums of x
+    (['Time_Delta'], centered on its mean to limit round-off), y, xy, x\ :sup:`2`\  and y\ :sup:`2`\  are computed
+    once, after which each least-squares line and its residual are obtained in closed form from the sums over its two
+    windows. Rows with missing values are left out of the fits, and windows are cut at the ends of **gas_df**.
+
+    .. note::   Here is an example
+
+                .. code-block:: python
+
+                    fits = fit_baselines(total_df,time_df['Charge_Start_Time'],change_gas_df['low_to_high'],'Corrected_Flow_Right',baseline_range=500)
+                    fits[fits['residual']>0.1]
+
+    :type gas_df: pd.DataFrame
+    :param gas_df: The dataframe that contains gas information, usually created by `pd.read_csv()` on gas data or `utils.merge_echem_gas_df()`
+
+    :type starts: list-like of datetime.datetime
+    :param starts: The start times of the CO2 capture or release processes
+
+    :type ends: list-like of datetime.datetime
+    :param ends: The end times of the CO2 capture or release processes
+
+    :type parameter: string
+    :param parameter: The dataset attribute used for baseline fitting, usually 'Corrected_Flow_Right'
+
+    :type baseline_range: int or list-like of int
+    :param baseline_range: Number of points before the start time and before the end time (after it if **reverse_outgas_baseline_range** is True) used for each baseline
+
+    :type reverse_outgas_baseline_range: boolean
+    :param reverse_outgas_baseline_range: If True, the second window is the **baseline_range** points from the end time
+
+    :type timeline_index: timeline.TimelineIndex
+    :param timeline_index: index over gas_df['Datetime'] used to locate **starts** and **ends**. If None, one is built.
+
+    :rtype: *pd.DataFrame*
+    :return: a dataset with one row per process:
+
+          dataset['slope'] -> (*float*): slope of the baseline, per hour of ['Time_Delta']\n
+          dataset['intercept'] -> (*float*): intercept of the baseline\n
+          dataset['start'] -> (*int*): row position of the start time\n
+          dataset['end'] -> (*int*): row position of the end time\n
+          dataset['points'] -> (*int*): number of points used in the fit\n
+          dataset['residual'] -> (*float*): root mean square residual of the fit, for checking the baseline\n
+    '''
+    if timeline_index is None:
+        timeline_index = timeline.TimelineIndex(gas_df)
+    start = np.array([timeline_index.locate(time) for time in starts],dtype=np.int64)
+    end = np.array([timeline_index.locate(time) for time in ends],dtype=np.int64)
+    fit = _fit_window_sums(_baseline_prefix_sums(gas_df,parameter),start,end,baseline_range,reverse_outgas_baseline_range)
+    return pd.DataFrame({'slope':fit['slope'],'intercept':fit['intercept'],'start':start,'end':end,'points':fit['points'],
+                         'residual':fit['residual']})
+
+def _baseline_prefix_sums(gas_df,parameter):
+    '''
+    Prefix sums of the baseline fits of `fit_baselines()` for **parameter**, computed once for any number of windows.
+    '''
+    x = gas_df['Time_Delta'].to_numpy(dtype=np.float64)
+    y = gas_df[parameter].to_numpy(dtype=np.float64)
+    valid = ~np.isnan(x)&~np.isnan(y)
+    x_mean = np.mean(x[valid]) if valid.any() else 0.0
+    x = np.where(valid,x-x_mean,0)
+    y = np.where(valid,y,0)
+    sums = {name:_prefix_sum(values) for name,values in [('n',valid),('x',x),('y',y),('xy',x*y),('xx',x*x),('yy',y*y)]}
+    sums['x_mean'] = x_mean
+    return sums
+
+def _fit_window_sums(sums,start,end,baseline_range,reverse_outgas_baseline_range=False):
+    '''
+    Least-squares lines over the windows of `fit_baselines()` from the prefix sums of `_baseline_prefix_sums()`.
+    **start**, **end** and **baseline_range** are broadcast against each other, e.g. ranges of shape (n, 1) against
+    cycles of shape (m,).
+    '''
+    rows = len(sums['n'])-1
+    baseline_range = np.asarray(baseline_range,dtype=np.int64)
+    #the two windows of every fit, as row ranges
+    first_window = (np.maximum(start-baseline_range,0),np.broadcast_to(start,np.broadcast(start,baseline_range).shape))
+    if not reverse_outgas_baseline_range:
+        second_window = (np.maximum(end-baseline_range,0),np.broadcast_to(end,np.broadcast(end,baseline_range).shape))
+    else:
+        second_window = (np.broadcast_to(end,np.broadcast(end,baseline_range).shape),np.minimum(end+baseline_range,rows))
+    S = {name:sums[name][first_window[1]]-sums[name][first_window[0]]+sums[name][second_window[1]]-sums[name][second_window[0]]
+         for name in ['n','x','y','xy','xx','yy']}
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        slope = (S['n']*S['xy']-S['x']*S['y'])/(S['n']*S['xx']-S['x']**2)
+        centered_intercept = (S['y']-slope*S['x'])/S['n']
+        #sum of squared residuals of a least-squares line
+        squared_residuals = S['yy']-slope*S['xy']-centered_intercept*S['y']
+        residual = np.sqrt(np.maximum(squared_residuals,0)/S['n'])
+    return {'slope':slope,'intercept':centered_intercept-slope*sums['x_mean'],'points':S['n'].astype(np.int64),'residual':residual}
+
+def _prefix_sum(values):
+    '''
+    Sums of **values** before each row, with one more element for the total, so that the sum over rows [a,b) is
+    prefix[b]-prefix[a].
+    '''
+    return np.concatenate(([0.0],np.cumsum(values)))
+
+def _shifted_window(start,end,shift_periods):
+    '''
+    Rows [first,last) of the windows [**start**,**end**) that still have a value after shifting each window by
+    **shift_periods** rows, as `pd.DataFrame.shift()` does on the window alone.
+    '''
+    first = np.asarray(start)+max(shift_periods,0)
+    return first,np.maximum(np.asarray(end)+min(shift_periods,0),first)
+
+def _shifted_prefix_sums(values,time_delta,shift_periods=0):
+    '''
+    Prefix sums of **values** shifted by **shift_periods** rows, and of **time_delta** and the row count where both
+    exist, for `_window_baseline_sums()`.
+    '''
+    shifted = pd.Series(values).shift(periods=shift_periods).to_numpy()
+    valid = ~np.isnan(shifted)&~np.isnan(time_delta)
+    return {'value':_prefix_sum(np.where(valid,shifted,0)),'time':_prefix_sum(np.where(valid,time_delta,0)),
+            'count':_prefix_sum(valid),'shift_periods':shift_periods}
+
+def _window_baseline_sums(sums,start,end,slope,intercept):
+    '''
+    For every window [**start**,**end**), sums the shifted values of **sums** (from `_shifted_prefix_sums()`) minus the
+    linear baseline slope*time_delta+intercept. Rows with missing values are skipped, as in `pd.Series.sum()`.
+    '''
+    first,last = _shifted_window(start,end,sums['shift_periods'])
+    return (sums['value'][last]-sums['value'][first]-slope*(sums['time'][last]-sums['time'][first])
+            -intercept*(sums['count'][last]-sums['count'][first]))
+
+def _window_constant_sums(values,baseline,weights,start,end,shift_periods=0):
+    '''
+    For every window [**start**,**end**), sums (**values** shifted by **shift_periods** rows - **baseline**)/60*weights.
+    Missing values, including the rows emptied by the shift, make the sum NaN.
+    '''
+    shifted = pd.Series(values).shift(periods=shift_periods).to_numpy()
+    terms = (shifted-baseline)/60.0*weights
+    missing = np.isnan(terms)
+    term_sum = _prefix_sum(np.where(missing,0,terms))
+    missing_count = _prefix_sum(missing)
+    first,last = _shifted_window(start,end,shift_periods)
+    #rows shifted out of a non-empty window are missing too
+    shifted_out = np.minimum(abs(shift_periods),np.maximum(np.asarray(end)-np.asarray(start),0))
+    return np.where(missing_count[last]-missing_count[first]+shifted_out>0,np.nan,term_sum[last]-term_sum[first])
+
+def _process_times(echem_time_df,gas_change_time_df,cycle,capture_period=0,outgas_period=0):
+    '''
+    Start and end times of the capture and outgas processes of the first **cycle** cycles, as in `calculate_amount()`.
+    '''
+    capture_start = echem_time_df['Charge_Start_Time'].iloc[:cycle].reset_index(drop=True)
+    outgas_start = echem_time_df['Discharge_Start_Time'].iloc[:cycle].reset_index(drop=True)
+    if not capture_period:
+        capture_end = gas_change_time_df['low_to_high'].iloc[:cycle].reset_index(drop=True)
+    else:
+        capture_end = capture_start+datetime.timedelta(0,capture_period)
+    if not outgas_period:
+        outgas_end = gas_change_time_df['high_to_low'].iloc[:cycle].reset_index(drop=True)
+    else:
+        outgas_end = outgas_start+datetime.timedelta(0,outgas_period)
+    return capture_start,capture_end,outgas_start,outgas_end
+
 def calculate_amount(gas_df,echem_time_df,gas_change_time_df,capture_parameter = 'Corrected_Flow_Right',outgas_parameter = 'Corrected_Flow_Right',
-                        baseline = 'Adaptive',cycle = 5, shift_periods = 0,baseline_range = 100,capture_baseline_range=0,outgas_baseline_range=0,capture_period=0,outgas_period=0,reverse_outgas_baseline_range=False):
+                        baseline = 'Adaptive',cycle = 5, shift_periods = 0,baseline_range = 100,capture_baseline_range=0,outgas_baseline_range=0,capture_period=0,outgas_period=0,reverse_outgas_baseline_range=False,timeline_index=None):
     ''' 
     Reads a gas info dataset created by `pd.read_csv()` on gas data or `utils.merge_echem_gas_df()`, and a time period dataset by `find_echem_time_period`.
     Calculates the amount of CO2 captured and released. Returns a dataset containing the cycle number, 
@@ -168,6 +572,9 @@ def calculate_amount(gas_df,echem_time_df,gas_change_time_df,capture_parameter =
     :type reverse_outgas_baseline_range: boolean
     :param reverse_capture_baseline_range: Input True when you want to use **outgas_period** to calculate the outgased amount. 
 
+    :type timeline_index: timeline.TimelineIndex
+    :param timeline_index: index over gas_df['Datetime'] shared by all lookups. If None, one is built once.
+
     :rtype: *pd.DataFrame*
     :return: 
           **dataset**: a dataset that contains the following attributes
@@ -180,84 +587,52 @@ def calculate_amount(gas_df,echem_time_df,gas_change_time_df,capture_parameter =
           dataset[c1] -> (*float*): intercept of the capture baseline\n
           dataset[o0] -> (*float*): slope the outgas baseline\n
           dataset[o1] -> (*float*): intercept of the outgas baseline\n
-          dataset[c_start] -> (*int*): index of the start of capture process\n
-          dataset[c_end] -> (*int*): index of the end of capture process\n
-          dataset[o_start] -> (*int*): index of the start of the release process\n
-          dataset[o_end]  -> (*int*): index of the end of the release process\n
+          dataset[c_start] -> (*int*): row position of the start of capture process\n
+          dataset[c_end] -> (*int*): row position of the end of capture process\n
+          dataset[o_start] -> (*int*): row position of the start of the release process\n
+          dataset[o_end]  -> (*int*): row position of the end of the release process\n
     
     '''
 
-    capture_amount_array = []
-    outgas_amount_array = []
-    cycle_number = []
-    c0_array = []
-    c1_array = []
-    c_start_array = []
-    c_end_array = []
-    o0_array = []
-    o1_array = []
-    o_start_array = []
-    o_end_array = []
-
-        
-    for i in range(cycle):
-        capture_start = echem_time_df.iloc[i]['Charge_Start_Time']
-        outgas_start = echem_time_df.iloc[i]['Discharge_Start_Time']
-        
-        if not capture_period: 
-            capture_end = gas_change_time_df.iloc[i]['low_to_high']
-        else:
-            capture_end = capture_start+datetime.timedelta(0,capture_period)
-        if not outgas_period:
-            outgas_end = gas_change_time_df.iloc[i]['high_to_low']
-        else:
-            outgas_end = outgas_start+datetime.timedelta(0,outgas_period)
-        
-        cycle_number.append(i+1)
-        capture_amount = 0
-        outgas_amount = 0
-        
-        #capture baseline parameter c,start_index and end_index
-        if capture_baseline_range:
-            baseline_range = capture_baseline_range
-        c,c_start,c_end = create_baseline(gas_df,capture_start,capture_end,capture_parameter,baseline_range = baseline_range)
-        
-        #outgas baseline parameter o1,o2
-        if outgas_baseline_range:
-            baseline_range = outgas_baseline_range
-        o,o_start,o_end = create_baseline(gas_df,outgas_start,outgas_end,outgas_parameter,baseline_range = baseline_range,reverse_outgas_baseline_range=reverse_outgas_baseline_range)
-        
-        c0_array.append(c[0])
-        c1_array.append(c[1])
-        c_start_array.append(c_start)
-        c_end_array.append(c_end)
-        
-        o0_array.append(o[0])
-        o1_array.append(o[1])
-        o_start_array.append(o_start)
-        o_end_array.append(o_end)
-        
-        capture_df = gas_df[(gas_df['Datetime']>=capture_start) & (gas_df['Datetime']<capture_end)]
-        outgas_df = gas_df[(gas_df['Datetime']>=outgas_start) & (gas_df['Datetime']<outgas_end)]
-        
-        if baseline == 'Adaptive':
-            #capture at intermediate CO2 partial pressure
-            if capture_parameter == 'Corrected_Flow_Right' or 'CO2Flow':
-                capture_amount = np.sum((capture_df.shift(periods=shift_periods)[capture_parameter]-(c[0]*capture_df['Time_Delta']+c[1])))/60.0
-            else:
-                capture_amount = np.sum((capture_df.shift(periods=shift_periods)[capture_parameter]-(c[0]*capture_df['Time_Delta']+c[1]))*11.7)/60.0
-                
-            outgas_amount = np.sum((outgas_df.shift(periods=shift_periods)[outgas_parameter]-(o[0]*outgas_df['Time_Delta']+o[1]))/60.0)
-            
-        else:
-            capture_amount = sum((capture_df.shift(periods=shift_periods)[capture_parameter]-baseline)/60.0*capture_df['Corrected_Flow_Right'])
-            outgas_amount = sum((outgas_df.shift(periods=shift_periods)[outgas_parameter]-baseline)/60.0)
-
-
-
-        capture_amount_array.append(capture_amount)
-        outgas_amount_array.append(outgas_amount)
-        average_amount_array = (np.abs(np.array(capture_amount_array))+np.array(outgas_amount_array))/2
+    if timeline_index is None:
+        timeline_index = timeline.TimelineIndex(gas_df)
+
+    capture_start,capture_end,outgas_start,outgas_end = _process_times(echem_time_df,gas_change_time_df,cycle,capture_period,outgas_period)
+    cycle_number = list(range(1,len(capture_start)+1))
+
+    #capture baseline parameter c,start_index and end_index, and outgas baseline parameter o
+    capture_range = capture_baseline_range or baseline_range
+    outgas_range = outgas_baseline_range or baseline_range
+    capture_fits = fit_baselines(gas_df,capture_start,capture_end,capture_parameter,baseline_range = capture_range,
+                                 timeline_index=timeline_index)
+    outgas_fits = fit_baselines(gas_df,outgas_start,outgas_end,outgas_parameter,baseline_range = outgas_range,
+                                reverse_outgas_baseline_range=reverse_outgas_baseline_range,timeline_index=timeline_index)
+    c = capture_fits[['slope','intercept']].to_numpy()
+    o = outgas_fits[['slope','intercept']].to_numpy()
+
+    #all capture and outgas windows at once, as row ranges
+    capture_window = timeline_index.ranges(capture_start,capture_end)
+    outgas_window = timeline_index.ranges(outgas_start,outgas_end)
+    time_delta = gas_df['Time_Delta'].to_numpy(dtype=np.float64)
+
+    if baseline == 'Adaptive':
+        #capture at intermediate CO2 partial pressure. The flow rate is used for both 'Corrected_Flow_Right' and 'CO2Flow'.
+        capture_sums = _shifted_prefix_sums(gas_df[capture_parameter].to_numpy(dtype=np.float64),time_delta,shift_periods)
+        outgas_sums = _shifted_prefix_sums(gas_df[outgas_parameter].to_numpy(dtype=np.float64),time_delta,shift_periods)
+        capture_amount_array = _window_baseline_sums(capture_sums,*capture_window,c[:,0],c[:,1])/60.0
+        outgas_amount_array = _window_baseline_sums(outgas_sums,*outgas_window,o[:,0],o[:,1])/60.0
+    else:
+        flow = gas_df['Corrected_Flow_Right'].to_numpy(dtype=np.float64)
+        capture_amount_array = _window_constant_sums(gas_df[capture_parameter].to_numpy(dtype=np.float64),baseline,flow,
+                                                     *capture_window,shift_periods)
+        outgas_amount_array = _window_constant_sums(gas_df[outgas_parameter].to_numpy(dtype=np.float64),baseline,
+                                                    np.ones(len(gas_df)),*outgas_window,shift_periods)
+
+    average_amount_array = (np.abs(capture_amount_array)+outgas_amount_array)/2
+    c0_array,c1_array = c[:,0],c[:,1]
+    o0_array,o1_array = o[:,0],o[:,1]
+    c_start_array,c_end_array = capture_fits['start'],capture_fits['end']
+    o_start_array,o_end_array = outgas_fits['start'],outgas_fits['end']
     dataset = pd.DataFrame({'Cycle_Number':cycle_number,
                             'Capture_Amount':capture_amount_array,
                             'Outgas_Amount':outgas_amount_array,
@@ -270,4 +645,128 @@ def calculate_amount(gas_df,echem_time_df,gas_change_time_df,capture_parameter =
                             'c_end':c_end_array,
                             'o_start':o_start_array,
                             'o_end':o_end_array})
-    return dataset
\ No newline at end of file
+    return dataset
+
+
+def sweep_amount(gas_df,echem_time_df,gas_change_time_df,capture_parameter = 'Corrected_Flow_Right',outgas_parameter = 'Corrected_Flow_Right',
+                 cycle = 5,capture_baseline_range = [100],outgas_baseline_range = [100],shift_periods = [0],
+                 reverse_outgas_baseline_range = [False],capture_period=0,outgas_period=0,timeline_index=None):
+    '''
+    Evaluates the adaptive-baseline capture and outgas amounts of `calculate_amount()` for every combination of the
+    listed **capture_baseline_range**, **outgas_baseline_range**, **shift_periods** and **reverse_outgas_baseline_range**,
+    to choose robust settings instead of trying them one by one with `plotting.plot_baseline_selection`. The prefix
+    sums of the baseline fits are computed once and those of the integrals once per value of **shift_periods**, after
+    which every combination costs O(1) per cycle.
+
+    .. note::   Here is an example
+
+                .. code-block:: python
+
+                    sweep_df = sweep_amount(total_df,time_df,change_gas_df,capture_baseline_range=range(100,3001,100),
+                                            outgas_baseline_range=range(100,3001,100),shift_periods=range(-10,11))
+                    spread = sweep_df.groupby(['capture_baseline_range','outgas_baseline_range','shift_periods'])['Average_Amount'].std()
+
+    :type gas_df: pd.DataFrame
+    :param gas_df: dataset (created by `pd.read_csv()` on gas data or `utils.merge_echem_gas_df()`) that contains gas information
+
+    :type echem_time_df: pd.DataFrame
+    :param echem_time_df: dataset (created by `echem_method.find_echem_time_period`) that has process start and end time information
+
+    :type gas_change_time_df: pd.DataFrame
+    :param gas_change_time_df: dataset (created by `find_gas_change_time()`) that has the time of gas composition change
+
+    :type capture_parameter: string
+    :param capture_parameter: The dataset attribute used for capture baseline fitting, usually "Corrected_Flow_Right"
+
+    :type outgas_parameter: string
+    :param outgas_parameter:  The dataset attribute used for outgas baseline fitting, usually "Corrected_Flow_Right"
+
+    :type cycle: int
+    :param cycle: Enter the number of capture/release cycles.
+
+    :type capture_baseline_range: list of int
+    :param capture_baseline_range: Values of the number of points used for the capture baselines
+
+    :type outgas_baseline_range: list of int
+    :param outgas_baseline_range: Values of the number of points used for the outgas baselines
+
+    :type shift_periods: list of int
+    :param shift_periods: Values of the number of indices to shift the capture/release parameter
+
+    :type reverse_outgas_baseline_range: list of boolean
+    :param reverse_outgas_baseline_range: Outgas baseline window choices, see `calculate_amount()`
+
+    :type capture_period: float
+    :param capture_period: see `calculate_amount()`
+
+    :type outgas_period: float
+    :param outgas_period: see `calculate_amount()`
+
+    :type timeline_index: timeline.TimelineIndex
+    :param timeline_index: index over gas_df['Datetime'] shared by all lookups. If None, one is built once.
+
+    :rtype: *pd.DataFrame*
+    :return:
+          **dataset**: a tidy dataset with one row per combination and cycle
+
+          dataset[Cycle_Number] -> (*int*): cycle_number\n
+          dataset[capture_baseline_range] -> (*int*): capture baseline range of the row\n
+          dataset[outgas_baseline_range] -> (*int*): outgas baseline range of the row\n
+          dataset[shift_periods] -> (*int*): shift of the row\n
+          dataset[reverse_outgas_baseline_range] -> (*boolean*): outgas baseline window choice of the row\n
+          dataset[Capture_Amount] -> (*float*): captured amount in this cycle\n
+          dataset[Outgas_Amount] -> (*float*): released amount in this cycle\n
+          dataset[Average_Amount] -> (*float*): average captured/released amount in this cycle\n
+          dataset[capture_residual] -> (*float*): root mean square residual of the capture baseline\n
+          dataset[outgas_residual] -> (*float*): root mean square residual of the outgas baseline\n
+    '''
+    if timeline_index is None:
+        timeline_index = timeline.TimelineIndex(gas_df)
+    capture_start,capture_end,outgas_start,outgas_end = _process_times(echem_time_df,gas_change_time_df,cycle,capture_period,outgas_period)
+    capture_window = timeline_index.ranges(capture_start,capture_end)
+    outgas_window = timeline_index.ranges(outgas_start,outgas_end)
+    c_start = np.array([timeline_index.locate(time) for time in capture_start],dtype=np.int64)
+    c_end = np.array([timeline_index.locate(time) for time in capture_end],dtype=np.int64)
+    o_start = np.array([timeline_index.locate(time) for time in outgas_start],dtype=np.int64)
+    o_end = np.array([timeline_index.locate(time) for time in outgas_end],dtype=np.int64)
+
+    capture_ranges = np.asarray(list(capture_baseline_range),dtype=np.int64)
+    outgas_ranges = np.asarray(list(outgas_baseline_range),dtype=np.int64)
+    shifts = list(shift_periods)
+    reverses = list(reverse_outgas_baseline_range)
+
+    #baselines of shape (ranges, cycles)
+    capture_fit = _fit_window_sums(_baseline_prefix_sums(gas_df,capture_parameter),c_start,c_end,capture_ranges[:,None])
+    outgas_sums = _baseline_prefix_sums(gas_df,outgas_parameter)
+    outgas_fits = [_fit_window_sums(outgas_sums,o_start,o_end,outgas_ranges[:,None],reverse) for reverse in reverses]
+
+    #amounts of shape (shifts, reverses, capture ranges, outgas ranges, cycles)
+    time_delta = gas_df['Time_Delta'].to_numpy(dtype=np.float64)
+    capture_values = gas_df[capture_parameter].to_numpy(dtype=np.float64)
+    outgas_values = gas_df[outgas_parameter].to_numpy(dtype=np.float64)
+    capture_amount = np.empty((len(shifts),1,len(capture_ranges),1,len(c_start)))
+    outgas_amount = np.empty((len(shifts),len(reverses),1,len(outgas_ranges),len(o_start)))
+    for i,shift in enumerate(shifts):
+        sums = _shifted_prefix_sums(capture_values,time_delta,shift)
+        capture_amount[i,0,:,0] = _window_baseline_sums(sums,*capture_window,capture_fit['slope'],capture_fit['intercept'])/60.0
+        if outgas_parameter != capture_parameter:
+            sums = _shifted_prefix_sums(outgas_values,time_delta,shift)
+        for j,fit in enumerate(outgas_fits):
+            outgas_amount[i,j,0] = _window_baseline_sums(sums,*outgas_window,fit['slope'],fit['intercept'])/60.0
+
+    shape = np.broadcast_shapes(capture_amount.shape,outgas_amount.shape)
+    grid = np.meshgrid(shifts,reverses,capture_ranges,outgas_ranges,np.arange(1,len(c_start)+1),indexing='ij')
+    capture_amount = np.broadcast_to(capture_amount,shape).ravel()
+    outgas_amount = np.broadcast_to(outgas_amount,shape).ravel()
+    capture_residual = np.broadcast_to(capture_fit['residual'][None,None,:,None],shape).ravel()
+    outgas_residual = np.broadcast_to(np.array([fit['residual'] for fit in outgas_fits])[None,:,None],shape).ravel()
+    return pd.DataFrame({'Cycle_Number':grid[4].ravel(),
+                         'capture_baseline_range':grid[2].ravel(),
+                         'outgas_baseline_range':grid[3].ravel(),
+                         'shift_periods':grid[0].ravel(),
+                         'reverse_outgas_baseline_range':grid[1].ravel(),
+                         'Capture_Amount':capture_amount,
+                         'Outgas_Amount':outgas_amount,
+                         'Average_Amount':(np.abs(capture_amount)+outgas_amount)/2,
+                         'capture_residual':capture_residual,
+                         'outgas_residual':outgas_residual})
@@ -0,0 +1,118 @@
+import pandas as pd
+import numpy as np
+
+#States of calc_dic.calc_DIC and the time (echem_time_df or gas_change_time_df attribute) each one is located at
+DIC_STATE_TIMES = {'3\'i':'Charge_Start_Time','1':'low_to_high','1\'':'Discharge_Start_Time','3':'high_to_low','3\'f':'Outgas_End_Time'}
+
+class TimelineIndex:
+    '''
+    Index over the sorted datetime attribute of a dataset, usually **total_df** created by `utils.merge_echem_gas_df()` or
+    the gas dataset. It is built once and answers exact, nearest and range queries by binary search (`np.searchsorted`)
+    in O(log n), instead of comparing the whole datetime column for every lookup. All results are row positions, to be
+    used with `.iloc`.
+
+    .. note::   Here is an example
+
+                .. code-block:: python
+
+                    timeline_index = TimelineIndex(total_df)
+                    states = timeline_index.map_states(time_df,change_gas_df)
+                    total_df.iloc[states[(2,'1')]]
+
+                    amount_df = gas_methods.calculate_amount(total_df,time_df,change_gas_df,timeline_index=timeline_index)
+                    dic_df = calc_dic.calc_DIC(total_df,time_df,change_gas_df,timeline_index=timeline_index)
+
+    :type dataset: pd.DataFrame
+    :param dataset: dataset with a datetime attribute sorted in ascending order
+
+    :type time_attribute: string
+    :param time_attribute: **dataset**'s attribute that contains datetime information, usually 'Datetime' or 'Time'.
+
+    :type tolerance: datetime.timedelta
+    :param tolerance: If None, **locate** only accepts exact timestamps. Otherwise it returns the nearest row within **tolerance**, which helps when the echem and gas clocks do not match exactly.
+    '''
+
+    def __init__(self,dataset,time_attribute='Datetime',tolerance=None):
+        self.times = dataset[time_attribute].to_numpy(dtype='datetime64[ns]')
+        if np.isnat(self.times).any() or (self.times[1:]<self.times[:-1]).any():
+            raise ValueError('{} must be sorted in ascending order and contain no missing values'.format(time_attribute))
+        self.tolerance = tolerance
+
+    def __len__(self):
+        return len(self.times)
+
+    @staticmethod
+    def _as_datetime64(time):
+        return np.asarray(pd.to_datetime(time),dtype='datetime64[ns]')
+
+    def exact(self,time):
+        '''
+        Returns the position of the first row at **time**. Raises KeyError if there is none.
+        '''
+        time = self._as_datetime64(time)
+        position = np.searchsorted(self.times,time,side='left')
+        if position == len(self.times) or self.times[position] != time:
+            raise KeyError('No row at {}'.format(time))
+        return int(position)
+
+    def nearest(self,time,tolerance=None):
+        '''
+        Returns the position of the row closest to **time** (the first one if several rows share that time). Raises
+        KeyError if it is further than **tolerance** away.
+        '''
+        time = self._as_datetime64(time)
+        position = int(np.searchsorted(self.times,time,side='left'))
+        if position == len(self.times) or (position > 0 and time-self.times[position-1] <= self.times[position]-time):
+            position = int(np.searchsorted(self.times,self.times[position-1],side='left'))
+        if tolerance is not None and abs(self.times[position]-time) > np.timedelta64(pd.Timedelta(tolerance)):
+            raise KeyError('No row within {} of {}'.format(tolerance,time))
+        return position
+
+    def locate(self,time):
+        '''
+        Returns the position of the row at **time**, exactly or within the **tolerance** given to the index.
+        '''
+        if self.tolerance is None:
+            return self.exact(time)
+        return self.nearest(time,self.tolerance)
+
+    def range(self,start,end):
+        '''
+        Returns the slice of row positions with **start** <= time < **end**, to be used with `.iloc`.
+        '''
+        return slice(int(np.searchsorted(self.times,self._as_datetime64(start),side='left')),
+                     int(np.searchsorted(self.times,self._as_datetime64(end),side='left')))
+
+    def ranges(self,starts,ends):
+        '''
+        Vectorized `range()`: returns two arrays with the first and past-the-end row positions of the rows with
+        **starts** <= time < **ends**, for arrays of times, e.g. one window per cycle.
+        '''
+        return (np.searchsorted(self.times,self._as_datetime64(starts),side='left'),
+                np.searchsorted(self.times,self._as_datetime64(ends),side='left'))
+
+    def map_states(self,echem_time_df,gas_change_time_df,outgas_shift=20):
+        '''
+        Maps (cycle, state) to row positions for the states of `calc_dic.calc_DIC()`: 3'i is the row after
+        echem_time_df['Charge_Start_Time'], 1 is at gas_change_time_df['low_to_high'], 1' at echem_time_df['Discharge_Start_Time'],
+        3 at gas_change_time_df['high_to_low'] and 3'f is **outgas_shift** rows before echem_time_df['Outgas_End_Time'].
+
+        :type echem_time_df: pd.DataFrame
+        :param echem_time_df: dataset created by `echem_methods.find_echem_time_period()`
+
+        :type gas_change_time_df: pd.DataFrame
+        :param gas_change_time_df: dataset created by `gas_methods.find_gas_change_time()`
+
+        :type outgas_shift: int
+        :param outgas_shift: Number of rows. Offsets inaccurate timing in **echem_time_df** or **gas_change_time_df**
+
+        :rtype: *dict*
+        :return: **states**, a new dictionary that maps (cycle, state) to a row position. The index itself is not modified, so it can be shared by callers with different **outgas_shift**.
+        '''
+        offsets = {'3\'i':1,'3\'f':-outgas_shift}
+        states = {}
+        for i in range(len(echem_time_df)):
+            for state,time_attribute in DIC_STATE_TIMES.items():
+                times = echem_time_df if time_attribute in echem_time_df.columns else gas_change_time_df
+                states[(i+1,state)] = self.locate(times.iloc[i][time_attribute])+offsets.get(state,0)
+        return states
@@ -7,11 +7,18 @@ from scipy.optimize import fsolve
 import calc_dic
 
 
+def _hours_since(time,start):
+    '''
+    Vectorized time difference in hours between the datetime64 series **time** and **start**, truncated to whole seconds.
+    '''
+    time_delta = pd.to_datetime(time)-start
+    return time_delta.dt.days*24+time_delta.dt.seconds/3600
+
 def merge_echem_gas_df(echem_df,gas_df,co2_fit_path='../20210103_right_CO2_sensor_cubic_spline_fit',max_loop_num=11,co2_heat_conductivity=0.685,flow_offset=0):
     
     '''
 
-    Merge **echem_df**, created by `echem_methods.read_echem()` function and **gas_df**, created by `pd.read_csv()` on gas data, on newly created ['Time_Delta'] attribute.
+    Merge **echem_df**, created by `echem_methods.read_echem()` function and **gas_df**, created by `gas_methods.read_gas_log()` or `pd.read_csv()` on gas data, on newly created ['Time_Delta'] attribute.
     Add ['right_pco2'] attribute to the merged dataset. The ['right_pco2'] attribute is created by using a previously-prepared cubic spline fit that
     fits CO2 sensor analog signal to actual CO2 partial pressure. 
 
@@ -37,7 +44,7 @@ def merge_echem_gas_df(echem_df,gas_df,co2_fit_path='../20210103_right_CO2_senso
     :return: Merged dataset containing, original **echem_df** and **gas_df** datasets, plus extra ['right_pco2'] attribute.
             Below is the list of additional attributes:
 
-            dataset['Time_Delta']-> (*int*): Time difference with respect to the start of the experiment. \n
+            dataset['Time_Delta']-> (*float*): Time difference in hours with respect to the start of the experiment, truncated to whole seconds. \n
             dataset['right_pco2']-> (*float*): CO2 partial pressure in bar. Converted from **CO2 sensor right** by previously determined spline-fit on analog input and CO2 partial pressure. \n
             dataset['Corrected_Flow_Right'] -> (*float*): Actual flow rate corrected from nominal flow rate and CO2 conductivity and offset value.\n
             dataset['Corrected_Flow_Right_filtered'] -> (*float*): Actual flow rate corrected from nominal flow rate and CO2 conductivity and offset value. `scipy.lfilter` is used to filtered the signal.\n
@@ -45,8 +52,9 @@ def merge_echem_gas_df(echem_df,gas_df,co2_fit_path='../20210103_right_CO2_senso
 
     '''
 
-    echem_df['Time_Delta']=(echem_df['Time']-gas_df['Datetime'].iloc[0]).apply(lambda x: x.days*24+x.seconds/3600)
-    gas_df['Time_Delta'] = (gas_df['Datetime']-gas_df['Datetime'].iloc[0]).apply(lambda x: x.days*24+x.seconds/3600)
+    #whole seconds, so that echem and gas rows recorded in the same second share the merge key
+    echem_df['Time_Delta'] = _hours_since(echem_df['Time'],gas_df['Datetime'].iloc[0])
+    gas_df['Time_Delta'] = _hours_since(gas_df['Datetime'],gas_df['Datetime'].iloc[0])
 
     total_df = gas_df.merge(echem_df,how='outer',on=['Time_Delta'])
     total_df = total_df[total_df['loop_num']<max_loop_num] #remove weird data
@@ -59,7 +67,7 @@ def merge_echem_gas_df(echem_df,gas_df,co2_fit_path='../20210103_right_CO2_senso
     a = 1
     filtered_right = lfilter(b,a,total_df['flow sensor right(sccm)'])
     total_df['right_pco2'] = right_co2_fit(total_df['CO2 sensor right(abs val)'])
-    total_df['right_pco2'] = total_df['right_pco2'].apply(lambda x: np.where(x>0.90,1,x))
+    total_df['right_pco2'] = np.where(total_df['right_pco2']>0.90,1,total_df['right_pco2'])
     
     filtered_co2_right = lfilter(b,a,total_df['right_pco2'])
     